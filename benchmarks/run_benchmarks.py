@@ -0,0 +1,240 @@
+# Benchmarks of the pipeline hot paths (wall time and peak memory)
+# Uses the committed results of one glacier as fixtures, nothing is downloaded:
+#   initial-geometries/res/RGI_ID/*, climate-background/res/RGI_ID/simulation_climate.nc, mass-balance-calibrations/res/RGI_ID/*.json
+# The historical climate of the OGGM shop is replaced by 30 years of the synthetic climate (relabelled to 1990-2019)
+# Benchmarks whose requirements (e.g. OGGM) are missing are skipped
+#
+# python benchmarks/run_benchmarks.py [--rgi-id RGI_ID] [--repeat N] [--only NAME ...] [--save] [--compare COMMIT or FILE]
+# --save writes benchmarks/baselines/COMMIT.json, --compare prints the ratios to a saved baseline (exit code 1 on regressions)
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import xarray as xr
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+from common.utils import glacier_paths, igm_inputs, oggm_nc_to_igm_nc
+
+BASELINE_DIR = ROOT + "/benchmarks/baselines"
+DEFAULT_RGI_ID = "RGI60-11.01450"
+REGRESSION_THRESHOLD = 1.2  # current / baseline time above this is reported as regression
+OGGM_YEARS = 20  # shortened horizon of the OGGM forward benchmark
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rgi-id", default=DEFAULT_RGI_ID, help="Glacier of the fixtures")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed repetitions")
+    parser.add_argument("--only", nargs="*", help="Names of the benchmarks to run")
+    parser.add_argument("--save", action="store_true", help="Save the results as baseline of the current commit")
+    parser.add_argument("--compare", help="Baseline to compare with (commit or JSON file)")
+    args = parser.parse_args()
+
+    # The stage scripts use paths relative to the repository root
+    os.chdir(ROOT)
+
+    temp_dir = tempfile.mkdtemp(prefix="benchmarks_")
+    try:
+        fixtures = create_fixtures(args.rgi_id, temp_dir)
+        results = {}
+        for name, setup in BENCHMARKS.items():
+            if args.only and name not in args.only:
+                continue
+            results[name] = run_benchmark(name, setup, fixtures, temp_dir, args.repeat)
+    finally:
+        shutil.rmtree(temp_dir)
+
+    report = {
+        "commit": git_commit(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.node(),
+        "rgi_id": args.rgi_id,
+        "repeat": args.repeat,
+        "results": results,
+    }
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(BASELINE_DIR + "/" + report["commit"] + ".json", "w") as file:
+            json.dump(report, file, indent=4)
+        print("Saved " + BASELINE_DIR + "/" + report["commit"] + ".json")
+
+    if args.compare:
+        regressions = compare(load_baseline(args.compare), report)
+        if regressions:
+            sys.exit(1)
+
+
+def create_fixtures(rgi_id, temp_dir):
+    paths = glacier_paths(rgi_id)
+    for key in ["gridded_data", "glacier_grid", "outlines", "climate"]:
+        if not os.path.exists(paths[key]):
+            raise FileNotFoundError("Missing fixture " + paths[key])
+
+    # Stand-in for climate_historical.nc of the OGGM shop
+    historical = temp_dir + "/climate_historical.nc"
+    with xr.open_dataset(paths["climate"], decode_times=False) as ds:
+        ds_hist = ds.isel(time=slice(0, 360)).load()
+    ds_hist = ds_hist.assign_coords(time=pd.date_range("1990-01-01", periods=360, freq="MS"))
+    ds_hist.to_netcdf(historical)
+
+    with xr.open_dataset(paths["gridded_data"]) as ds:
+        thicknesses = [var for var in ds.data_vars if "thickness" in var or var == "oggm_inv_distributed"]
+
+    return {"rgi_id": rgi_id, "paths": paths, "historical_climate": historical, "thicknesses": thicknesses}
+
+
+def run_benchmark(name, setup, fixtures, temp_dir, repeat):
+    work_dir = temp_dir + "/" + name
+    os.makedirs(work_dir)
+    try:
+        func = setup(fixtures, work_dir)
+    except ImportError as error:
+        print(name + ": skipped (" + str(error) + ")")
+        return {"skipped": str(error)}
+
+    func()  # warm-up (imports, file caches)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    # Separate run for the memory, tracemalloc slows down the code
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result = {"time_s": float(np.median(times)), "time_min_s": float(np.min(times)), "peak_mib": peak / 2**20}
+    print(name + ": " + format(result["time_s"], ".4f") + " s (min " + format(result["time_min_s"], ".4f") + " s), peak " + format(result["peak_mib"], ".1f") + " MiB")
+    return result
+
+
+# Benchmarks: setup(fixtures, work_dir) returns the function to time, ImportError skips the benchmark
+
+
+def bench_igm_input(fixtures, work_dir):
+    return lambda: oggm_nc_to_igm_nc(fixtures["paths"]["gridded_data"], work_dir + "/igm_input.nc")
+
+
+def bench_igm_inputs_all(fixtures, work_dir):
+    # All thicknesses from one read, without the reuse of existing files
+    def func():
+        shutil.rmtree(work_dir + "/inputs", ignore_errors=True)
+        igm_inputs(fixtures["paths"]["gridded_data"], fixtures["thicknesses"], work_dir + "/inputs")
+
+    return func
+
+
+def bench_simulation_climate(fixtures, work_dir):
+    stage = load_stage("climate-background/create_climate_file.py")
+    return lambda: stage.simulation_climate(fixtures["historical_climate"], work_dir + "/simulation_climate.nc")
+
+
+def bench_simulation_climate_members(fixtures, work_dir):
+    stage = load_stage("climate-background/create_climate_file.py")
+    return lambda: stage.simulation_climate(fixtures["historical_climate"], work_dir + "/simulation_climate_ensemble.nc", n_members=10)
+
+
+def bench_write_gridded_data(fixtures, work_dir):
+    # Successor of copy_variable_between_netcdfs: all fields added and written at once
+    stage = load_stage("initial-geometries/get_initial_data.py")
+    with xr.open_dataset(fixtures["paths"]["gridded_data"]) as ds:
+        fields = {"benchmark_thickness": ds[fixtures["thicknesses"][0]].load()}
+    return lambda: stage.write_gridded_data(fixtures["paths"]["gridded_data"], fields, work_dir + "/gridded_data.nc")
+
+
+def bench_has_var(fixtures, work_dir):
+    stage = load_stage("forward-runs/run_projections.py")
+    return lambda: [stage.has_var(fixtures["paths"]["gridded_data"], thickness) for thickness in stage.thicknesses]
+
+
+def bench_oggm_forward(fixtures, work_dir):
+    # Flowline preprocessing and a short forward run for the first thickness and calibration
+    stage = load_stage("forward-runs/run_projections.py")
+    from oggm import tasks
+
+    rgi_id = fixtures["rgi_id"]
+    thickness = fixtures["thicknesses"][0]
+    calib_file = fixtures["paths"]["calibs"] + "/" + stage.calibs[0] + ".json"
+
+    def func():
+        gdir = stage.init_oggm_gdir(rgi_id, work_dir + "/gdir", fixtures["paths"]["climate"])
+        shutil.copy(calib_file, gdir.dir + "/mb_calib.json")
+        stage.prepare_simulation(gdir, thk_var=thickness)
+        tasks.run_from_climate_data(
+            gdir,
+            ys=stage.start_year,
+            ye=stage.start_year + OGGM_YEARS,
+            climate_filename="climate_historical",
+            climate_input_filesuffix="",
+            output_filesuffix="_benchmark",
+            store_model_geometry=False,
+        )
+
+    return func
+
+
+BENCHMARKS = {
+    "igm_input": bench_igm_input,
+    "igm_inputs_all": bench_igm_inputs_all,
+    "simulation_climate": bench_simulation_climate,
+    "simulation_climate_members": bench_simulation_climate_members,
+    "write_gridded_data": bench_write_gridded_data,
+    "has_var": bench_has_var,
+    "oggm_forward": bench_oggm_forward,
+}
+
+
+def load_stage(path):
+    # Stage scripts are loaded like in workflow.py (ImportError if e.g. OGGM is missing)
+    from workflow import load_stage as load_workflow_stage
+
+    return load_workflow_stage(path)
+
+
+def git_commit():
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+    return result.stdout.strip() if result.returncode == 0 else "unknown"
+
+
+def load_baseline(ref):
+    path = ref if os.path.isfile(ref) else BASELINE_DIR + "/" + ref + ".json"
+    with open(path, "r") as file:
+        return json.load(file)
+
+
+def compare(baseline, report):
+    print()
+    print("Compared with " + baseline["commit"] + " (" + baseline["date"] + ")")
+    regressions = []
+    for name, result in report["results"].items():
+        base = baseline["results"].get(name)
+        if base is None or "skipped" in base or "skipped" in result:
+            print(name + ": no comparison")
+            continue
+        ratio = result["time_s"] / base["time_s"]
+        memory_ratio = result["peak_mib"] / base["peak_mib"] if base["peak_mib"] > 0 else 1.0
+        flag = ""
+        if ratio > REGRESSION_THRESHOLD:
+            flag = "  <- regression"
+            regressions.append(name)
+        print(name + ": time x" + format(ratio, ".2f") + ", peak memory x" + format(memory_ratio, ".2f") + flag)
+    return regressions
+
+
+if __name__ == "__main__":
+    main()
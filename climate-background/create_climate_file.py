@@ -6,21 +6,20 @@
 import os
 import shutil
 import sys
-import cftime
 import numpy as np
 import oggm.cfg as cfg
-import oggm.workflow as workflow
 import xarray as xr
 
-if len(sys.argv) <= 1:
-    RGI_ID = "RGI60-11.01450"
-else:
-    RGI_ID = sys.argv[1]
+# Import utils
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from common.gdir_cache import init_cached_gdir
+from common.catalog import update_catalog
+from common.datasets import release
 
 NO_SPINUP_URL = "https://cluster.klima.uni-bremen.de/~oggm/gdirs/oggm_v1.6/L3-L5_files/2023.3/elev_bands/W5E5"
-TEMP_WD = "climate-background/temp"
-OUT_FOLDER_NAME = "res/" + RGI_ID
+TEMP_WD = "climate-background/temp"  # TEMP_WD/RGI_ID
 OUT_FILE_NAME = "simulation_climate.nc"
+ENSEMBLE_FILE_NAME = "simulation_climate_ensemble.nc"  # only written for more than one member
 
 # Scaling factor of the standard distribution for random extension
 # Use 0 for the monthly mean of climate variables
@@ -28,6 +27,12 @@ sd_scale = 1
 
 seed = 0  # Random seed
 
+# Repeat the observed months instead of drawing random values
+repeated = False
+
+# Shuffle the order of the synthetic years
+shuffle_years = False
+
 reference_climate_period_start = "1990-01-01"
 reference_climate_period_end = "2019-12-01"
 
@@ -35,23 +40,36 @@ reference_climate_period_end = "2019-12-01"
 synthetic_start_date = "2000-01-01"
 synthetic_end_date = "2999-12-01"
 
+# Chunk size (months) of the ensemble file, one member per chunk
+ensemble_chunk_months = 1200
 
-def main():
+
+def main(rgi_id, n_members=1):
     cfg.initialize()
 
-    cfg.PATHS["working_dir"] = TEMP_WD
+    temp_wd = TEMP_WD + "/" + rgi_id
+    cfg.PATHS["working_dir"] = temp_wd
+
+    climate_gdir = init_cached_gdir(rgi_id, NO_SPINUP_URL, 3)
 
-    climate_gdir = workflow.init_glacier_directories(RGI_ID, prepro_base_url=NO_SPINUP_URL, from_prepro_level=3, reset=True, force=True)[0]
+    out = "climate-background/res/" + rgi_id + "/" + OUT_FILE_NAME
+    simulation_climate(climate_gdir.dir + "/climate_historical.nc", out)
 
-    simulation_climate(climate_gdir.dir + "/climate_historical.nc", "climate-background/" + OUT_FOLDER_NAME + "/" + OUT_FILE_NAME)
+    check_climate_files(climate_gdir, out)
+    update_catalog([out])
 
-    check_climate_files(climate_gdir)
+    # Additional members of the stochastic climate in one file
+    if n_members > 1:
+        out_ensemble = "climate-background/res/" + rgi_id + "/" + ENSEMBLE_FILE_NAME
+        simulation_climate(climate_gdir.dir + "/climate_historical.nc", out_ensemble, n_members=n_members)
+        update_catalog([out_ensemble])
 
     # Clean gdir
-    shutil.rmtree(TEMP_WD)
+    shutil.rmtree(temp_wd)
 
 
-def simulation_climate(climate_data_file, out):
+def simulation_climate(climate_data_file, out, n_members=None):
+    # n_members=None: single realisation, otherwise a dataset with a member dimension
     ds = xr.open_dataset(climate_data_file)
 
     # Convert strings to numpy.datetime64
@@ -69,103 +87,92 @@ def simulation_climate(climate_data_file, out):
     selected_time = ds.sel(time=slice(reference_climate_period_start, reference_climate_period_end))
 
     # Generate a range of dates (1000 years)
-    year, month, day = map(int, synthetic_end_date.split("-"))
-    end_date = cftime.DatetimeGregorian(year, month, day)
-
-    year, month, day = map(int, synthetic_start_date.split("-"))
-    start_date = cftime.DatetimeGregorian(year, month, day)
-
-    monthly_dates = [start_date]
-    while monthly_dates[-1] < end_date:
-        year, month = monthly_dates[-1].year, monthly_dates[-1].month
-        next_month = month + 1 if month < 12 else 1
-        next_year = year if month < 12 else year + 1
-        monthly_dates.append(cftime.DatetimeGregorian(next_year, next_month, 1))
-
-    # Group climate data by month
-    climatology_mean = selected_time.groupby("time.month").mean()
-    climatology_std = selected_time.groupby("time.month").std()
+    monthly_dates = xr.date_range(synthetic_start_date, synthetic_end_date, freq="MS", calendar="gregorian", use_cftime=True)
 
     # Generate synthetic future data
-    future_prcp = []
-    future_temp = []
-    np.random.seed(seed)
-
-    for t in monthly_dates:
-        month = t.month
-
-        # Generate random variation based on monthly climate data
-        temp_val = np.random.normal(loc=climatology_mean.temp.sel(month=month), scale=sd_scale * (climatology_std.temp.sel(month=month)))
-        future_temp.append(temp_val)
-
-        prcp_val = np.random.normal(loc=climatology_mean.prcp.sel(month=month), scale=sd_scale * climatology_std.prcp.sel(month=month))
-        prcp_val = max(0, prcp_val)  # prcp cannot be negative
-        future_prcp.append(prcp_val)
-
-    # Convert to arrays
-    future_prcp = np.array(future_prcp)
-    future_temp = np.array(future_temp)
-    
-    repeated = False
-    if repeated:
-        # Generate synthetic future data by repeating observed monthly means
-        future_prcp = []
-        future_temp = []
+    months = np.asarray(monthly_dates.month)
+    coords = {"time": monthly_dates.values}
+    if n_members is None:
+        future_temp, future_prcp = synthetic_series(selected_time, months, [np.random.default_rng(seed)])
+        future_temp = future_temp[0]
+        future_prcp = future_prcp[0]
+        dims = ["time"]
+        encoding = None
+
+    else:
+        # Independent random stream per member (member k does not depend on the number of members)
+        rngs = [np.random.default_rng(stream) for stream in np.random.SeedSequence(seed).spawn(n_members)]
+        future_temp, future_prcp = synthetic_series(selected_time, months, rngs)
+        dims = ["member", "time"]
+        coords["member"] = np.arange(n_members)
+
+        # Chunked along member and time so single members can be read without loading the others
+        chunks = (1, min(ensemble_chunk_months, len(months)))
+        encoding = {var: {"zlib": True, "complevel": 4, "chunksizes": chunks} for var in ["prcp", "temp"]}
+
+    # Create the new extended dataset
+    ds_synthetic = xr.Dataset(
+        {
+            "prcp": (dims, future_prcp),
+            "temp": (dims, future_temp),
+        },
+        coords=coords,
+        attrs=ds.attrs,  # Keep original metadata
+    )
+    ds_synthetic.attrs["yr_0"] = int(reference_climate_period_start[:4])
+    ds_synthetic.attrs["yr_1"] = int(reference_climate_period_end[:4])
 
-        obs_temp = selected_time.temp.values  # e.g. shape (n_months,)
-        obs_prcp = selected_time.prcp.values
-        n_obs_months = len(obs_temp)
+    if not os.path.exists(os.path.dirname(out)):
+        os.makedirs(os.path.dirname(out))
+    release(out)
+    ds_synthetic.to_netcdf(out, encoding=encoding)
 
-        for i, t in enumerate(monthly_dates):
-            idx = i % n_obs_months  # wrap around when exceeding observed record
-            future_temp.append(obs_temp[idx])
-            prcp_val = max(0, obs_prcp[idx])  # keep prcp non-negative
-            future_prcp.append(prcp_val)
 
-        future_temp = np.array(future_temp)
-        future_prcp = np.array(future_prcp)
+def synthetic_series(selected_time, months, rngs):
+    # One row per random stream, all months are generated at once
+    # The monthly climatology is indexed with (month - 1)
+    month_idx = months - 1
+    n_streams = len(rngs)
 
-    shuffle_years = False
-    if shuffle_years:
-        # --- Step 2: shuffle the years in the repeated dataset ---
-        n_future_months = len(future_temp)
-        n_future_years = n_future_months // 12
+    if repeated:
+        # Repeat the observed months, wrap around when exceeding the observed record
+        obs_idx = np.arange(len(months)) % selected_time.sizes["time"]
+        future_temp = np.tile(selected_time.temp.values[obs_idx], (n_streams, 1))
+        future_prcp = np.tile(selected_time.prcp.values[obs_idx], (n_streams, 1))
 
-        # Reshape into years × 12 months
-        future_temp_years = future_temp.reshape(n_future_years, 12)
-        future_prcp_years = future_prcp.reshape(n_future_years, 12)
+    else:
+        # Random variation based on monthly climate data
+        climatology_mean = selected_time.groupby("time.month").mean().sel(month=np.arange(1, 13))
+        climatology_std = selected_time.groupby("time.month").std().sel(month=np.arange(1, 13))
 
-        # Shuffle the order of years
-        rng = np.random.default_rng(seed)
-        shuffled_indices = rng.permutation(n_future_years)
+        temp_mean = climatology_mean.temp.values[month_idx]
+        temp_std = climatology_std.temp.values[month_idx]
+        prcp_mean = climatology_mean.prcp.values[month_idx]
+        prcp_std = climatology_std.prcp.values[month_idx]
 
-        future_temp = future_temp_years[shuffled_indices].reshape(-1)
-        future_prcp = future_prcp_years[shuffled_indices].reshape(-1)
+        future_temp = np.stack([rng.normal(loc=temp_mean, scale=sd_scale * temp_std) for rng in rngs])
+        future_prcp = np.stack([rng.normal(loc=prcp_mean, scale=sd_scale * prcp_std) for rng in rngs])
 
+    future_prcp = np.maximum(0, future_prcp)  # prcp cannot be negative
 
+    if shuffle_years:
+        # Shuffle the order of the years (streams x years x 12 months)
+        n_future_years = len(months) // 12
+        shuffled_indices = np.stack([rng.permutation(n_future_years) for rng in rngs])[:, :, np.newaxis]
 
-    # Create the new extended dataset
-    ds_synthetic = xr.Dataset(
-        {
-            "prcp": (["time"], future_prcp),
-            "temp": (["time"], future_temp),
-        },
-        coords={"time": np.concatenate([monthly_dates])},
-        attrs=ds.attrs,  # Keep original metadata
-    )
-    ds_synthetic.attrs["yr_0"] = int(reference_climate_period_start[:4])
-    ds_synthetic.attrs["yr_1"] = int(reference_climate_period_end[:4])
+        future_temp = np.take_along_axis(future_temp.reshape(n_streams, n_future_years, 12), shuffled_indices, axis=1)
+        future_prcp = np.take_along_axis(future_prcp.reshape(n_streams, n_future_years, 12), shuffled_indices, axis=1)
+        future_temp = future_temp.reshape(n_streams, -1)
+        future_prcp = future_prcp.reshape(n_streams, -1)
 
-    if not os.path.exists("climate-background/" + OUT_FOLDER_NAME):
-        os.makedirs("climate-background/" + OUT_FOLDER_NAME)
-    ds_synthetic.to_netcdf(out)
+    return future_temp, future_prcp
 
 
-def check_climate_files(climate_gdir):
+def check_climate_files(climate_gdir, out):
     # Check if the monthly mean of the synthetic climate equals the original data
 
     ds_historic = xr.open_dataset(climate_gdir.dir + "/climate_historical.nc")
-    ds_synthetic = xr.open_dataset("climate-background/" + OUT_FOLDER_NAME + "/" + OUT_FILE_NAME)
+    ds_synthetic = xr.open_dataset(out)
 
     hist_values = ds_historic.sel(time=slice(reference_climate_period_start, reference_climate_period_end))
 
@@ -178,4 +185,8 @@ def check_climate_files(climate_gdir):
     print(np.mean(synt_values["temp"].values[::12]))
 
 
-main()
+if __name__ == "__main__":
+    # Arguments: RGI_ID [N_MEMBERS]
+    rgi_id = "RGI60-11.01450" if len(sys.argv) <= 1 else sys.argv[1]
+    n_members = 1 if len(sys.argv) <= 2 else int(sys.argv[2])
+    main(rgi_id, n_members)
@@ -0,0 +1,172 @@
+# Vectorized mass balance calibration of many glaciers and calibration schemes at once
+# Same approach as OGGM's mb_calibration_from_geodetic_mb (without the informed threestep):
+#   the first parameter of the scheme is calibrated within its bounds, the others keep their default values
+#   if the solution is outside the bounds, the parameter is set to the bound and the next parameter is calibrated
+# The specific MB of the monthly TI model (see common/smb.py) is linear in melt_f and prcp_fac for a fixed temp_bias:
+#   MB = prcp_fac * solid_prcp(temp_bias) - melt_f * melt(temp_bias)
+# so melt_f and prcp_fac are solved in closed form and temp_bias by a bisection for all glaciers at once
+#
+# Glacier inputs (dict): heights and weights (area) of the elevation bands, monthly temp/prcp of the reference period (complete years),
+# ref_hgt, reference_mb (kg m-2 yr-1) and the global parameters (mb_global_params of the calibration files)
+# or the climate aggregates of a glacier (see climate_aggregates), which make the calibration independent of the climate record length
+# Scheme (dict): order (three parameter names), defaults and bounds (min, max) per parameter
+
+import numpy as np
+
+PARAMS = ["melt_f", "prcp_fac", "temp_bias"]
+BISECTION_STEPS = 60
+
+# Temperature bias grid of the climate aggregates
+AGGREGATE_TEMP_BIAS_RANGE = (-10, 10)
+AGGREGATE_TEMP_BIAS_STEP = 0.05
+
+
+def calibrate(glaciers, schemes):
+    # Returns {scheme: {param: array over glaciers}}, all scheme x glacier combinations are solved together
+    # NaN marks combinations without a solution within the bounds of all parameters
+    stacked = stack_aggregates(glaciers) if "solid" in glaciers[0] else stack_inputs(glaciers)
+    n = len(glaciers)
+    names = list(schemes)
+
+    # Rows: scheme 1 glaciers, scheme 2 glaciers, ...
+    def per_row(get):
+        return np.concatenate([np.repeat(get(schemes[name]), n) for name in names])
+
+    inputs = {key: np.concatenate([value] * len(names)) for key, value in stacked.items()}
+    values = {param: per_row(lambda scheme: float(scheme["defaults"][param])) for param in PARAMS}
+    bounds = {param: (per_row(lambda scheme: float(scheme["bounds"][param][0])), per_row(lambda scheme: float(scheme["bounds"][param][1]))) for param in PARAMS}
+
+    done = np.zeros(len(names) * n, dtype=bool)
+    for step in range(3):
+        step_params = per_row(lambda scheme: scheme["order"][step])
+        for param in PARAMS:
+            rows = ~done & (step_params == param)
+            if not rows.any():
+                continue
+            low, high = bounds[param][0][rows], bounds[param][1][rows]
+            solution, inside = solve(param, subset(inputs, rows), {p: values[p][rows] for p in PARAMS}, low, high)
+            values[param][rows] = solution
+            done[rows] = inside
+
+    for param in PARAMS:
+        values[param][~done] = np.nan
+    return {name: {param: values[param][i * n : (i + 1) * n] for param in PARAMS} for i, name in enumerate(names)}
+
+
+def solve(param, inputs, values, low, high):
+    # Parameter value that matches the reference MB, clipped to the bounds; second return: solution inside the bounds
+    target = inputs["reference_mb"]
+    if param == "temp_bias":
+        return solve_temp_bias(inputs, values["melt_f"], values["prcp_fac"], low, high)
+
+    solid, melt = mb_terms(inputs, values["temp_bias"])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if param == "melt_f":
+            solution = (values["prcp_fac"] * solid - target) / melt
+        else:
+            solution = (target + values["melt_f"] * melt) / solid
+    solution = np.nan_to_num(solution, nan=np.inf)
+    inside = (solution >= low) & (solution <= high)
+    return np.clip(solution, low, high), inside
+
+
+def solve_temp_bias(inputs, melt_f, prcp_fac, low, high):
+    # The MB decreases with the temperature, bisection on [low, high] for all rows at once
+    def residual(temp_bias):
+        solid, melt = mb_terms(inputs, temp_bias)
+        return prcp_fac * solid - melt_f * melt - inputs["reference_mb"]
+
+    res_low = residual(low)
+    res_high = residual(high)
+    inside = (res_low >= 0) & (res_high <= 0)
+
+    a = low.copy()
+    b = high.copy()
+    for _ in range(BISECTION_STEPS):
+        mid = (a + b) / 2
+        positive = residual(mid) > 0
+        a = np.where(positive, mid, a)
+        b = np.where(positive, b, mid)
+    solution = (a + b) / 2
+
+    # No root: the bound with the smaller residual (MB too low even at the lowest temperature -> low)
+    solution = np.where(inside, solution, np.where(res_low < 0, low, high))
+    return solution, inside
+
+
+def climate_aggregates(glacier):
+    # Mean annual solid precipitation and melt (positive degree months x 365 / 12) over the glacier on a temp_bias grid
+    # Calibrations with these aggregates only interpolate them, the climate record is not needed anymore
+    low, high = AGGREGATE_TEMP_BIAS_RANGE
+    grid = np.arange(low, high + AGGREGATE_TEMP_BIAS_STEP / 2, AGGREGATE_TEMP_BIAS_STEP)
+    inputs = {key: np.repeat(value, len(grid), axis=0) for key, value in stack_inputs([glacier]).items()}
+    solid, melt = mb_terms(inputs, grid)
+    return {"temp_bias": grid, "solid": solid, "melt": melt, "reference_mb": glacier["reference_mb"]}
+
+
+def mb_terms(inputs, temp_bias):
+    # Mean annual solid precipitation (prcp_fac 1) and melt (melt_f 1) over the glacier, rows x 1
+    if "solid" in inputs:
+        return interpolate_aggregates(inputs, temp_bias)
+
+    temp = inputs["temp"][:, np.newaxis, :] + (temp_bias[:, np.newaxis] + inputs["gradient"][:, np.newaxis] * (inputs["heights"] - inputs["ref_hgt"][:, np.newaxis]))[:, :, np.newaxis]
+    melt = np.maximum(temp - inputs["temp_melt"][:, np.newaxis, np.newaxis], 0) * 365 / 12
+    solid_fraction = np.clip((inputs["temp_all_liq"][:, np.newaxis, np.newaxis] - temp) / (inputs["temp_all_liq"] - inputs["temp_all_solid"])[:, np.newaxis, np.newaxis], 0, 1)
+    solid = inputs["prcp"][:, np.newaxis, :] * solid_fraction
+
+    # Sum over the months, weighted mean over the bands (padded bands have weight 0)
+    weights = inputs["weights"] / inputs["weights"].sum(axis=1, keepdims=True)
+    return (solid.sum(axis=2) * weights).sum(axis=1) / inputs["n_years"], (melt.sum(axis=2) * weights).sum(axis=1) / inputs["n_years"]
+
+
+def stack_inputs(glaciers):
+    # Glaciers x bands / months arrays, padded with zero weights (bands) and zeros (months of shorter records)
+    n_bands = max(len(glacier["heights"]) for glacier in glaciers)
+    n_months = max(len(glacier["temp"]) for glacier in glaciers)
+    stacked = {
+        "heights": np.zeros((len(glaciers), n_bands)),
+        "weights": np.zeros((len(glaciers), n_bands)),
+        "temp": np.full((len(glaciers), n_months), -100.0),  # no melt, all solid
+        "prcp": np.zeros((len(glaciers), n_months)),
+    }
+    for i, glacier in enumerate(glaciers):
+        stacked["heights"][i, : len(glacier["heights"])] = glacier["heights"]
+        stacked["weights"][i, : len(glacier["weights"])] = glacier["weights"]
+        stacked["temp"][i, : len(glacier["temp"])] = glacier["temp"]
+        stacked["prcp"][i, : len(glacier["prcp"])] = glacier["prcp"]
+
+    stacked["n_years"] = np.array([len(glacier["temp"]) / 12 for glacier in glaciers])
+    stacked["ref_hgt"] = np.array([glacier["ref_hgt"] for glacier in glaciers], dtype=float)
+    stacked["reference_mb"] = np.array([glacier["reference_mb"] for glacier in glaciers], dtype=float)
+    for key, name in [("gradient", "temp_default_gradient"), ("temp_melt", "temp_melt"), ("temp_all_solid", "temp_all_solid"), ("temp_all_liq", "temp_all_liq")]:
+        stacked[key] = np.array([glacier["mb_global_params"][name] for glacier in glaciers], dtype=float)
+    return stacked
+
+
+def interpolate_aggregates(inputs, temp_bias):
+    # Linear interpolation on the temp_bias grid (the same for all rows), constant beyond its ends
+    grid = inputs["temp_bias_grid"]
+    position = (temp_bias - grid[:, 0]) / (grid[:, 1] - grid[:, 0])
+    index = np.clip(np.floor(position).astype(int), 0, grid.shape[1] - 2)
+    fraction = np.clip(position - index, 0, 1)[:, np.newaxis]
+    index = index[:, np.newaxis]
+
+    def interpolate(table):
+        left = np.take_along_axis(table, index, axis=1)
+        right = np.take_along_axis(table, index + 1, axis=1)
+        return (left * (1 - fraction) + right * fraction)[:, 0]
+
+    return interpolate(inputs["solid"]), interpolate(inputs["melt"])
+
+
+def stack_aggregates(aggregates):
+    return {
+        "temp_bias_grid": np.array([glacier["temp_bias"] for glacier in aggregates]),
+        "solid": np.array([glacier["solid"] for glacier in aggregates]),
+        "melt": np.array([glacier["melt"] for glacier in aggregates]),
+        "reference_mb": np.array([glacier["reference_mb"] for glacier in aggregates], dtype=float),
+    }
+
+
+def subset(inputs, rows):
+    return {key: value[rows] for key, value in inputs.items()}
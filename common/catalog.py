@@ -0,0 +1,109 @@
+# Index of the result files of the pipeline stages: STAGE/res/catalog.json
+# Entries are stored per RGI ID and file name (RGI_ID/FILE):
+#   size, mtime_ns, sha256, and for NetCDF files variables, dims, resolution (grid spacing) and time range, for JSON files the keys
+# The stages update the catalog when they write their results
+# An entry is only used while size and modification time of the file match, otherwise the file is indexed again
+
+import json
+import os
+import cftime
+import xarray as xr
+
+from common.utils import file_hash, file_lock
+
+CATALOG_NAME = "catalog.json"
+
+_catalogs = {}  # catalog file -> (mtime_ns, content), read once per process until it changes
+
+
+def catalog_location(path):
+    # RES_FOLDER/RGI_ID/FILE -> RES_FOLDER/catalog.json, RGI_ID/FILE
+    rgi_folder = os.path.dirname(os.path.abspath(path))
+    return os.path.dirname(rgi_folder) + "/" + CATALOG_NAME, os.path.basename(rgi_folder) + "/" + os.path.basename(path)
+
+
+def update_catalog(paths):
+    # Index the given files (all in the same res folder)
+    catalog_file, _ = catalog_location(paths[0])
+    with file_lock(catalog_file + ".lock"):
+        catalog = read_catalog(catalog_file)
+        for path in paths:
+            location, key = catalog_location(path)
+            if location != catalog_file:
+                raise ValueError(path + " is not in the res folder of " + catalog_file)
+            if os.path.exists(path):
+                catalog[key] = describe_file(path)
+            else:
+                catalog.pop(key, None)
+
+        with open(catalog_file + ".tmp", "w") as file:
+            json.dump(catalog, file, indent=4)
+        os.replace(catalog_file + ".tmp", catalog_file)
+
+
+def lookup(path):
+    # Catalog entry of the file, None if it does not exist or is outdated
+    catalog_file, key = catalog_location(path)
+    entry = read_catalog(catalog_file).get(key)
+    if entry is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    if entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+        return None
+    return entry
+
+
+def file_info(path):
+    # Catalog entry, the file is indexed if needed (None if it does not exist)
+    entry = lookup(path)
+    if entry is None and os.path.exists(path):
+        update_catalog([path])
+        entry = lookup(path)
+    return entry
+
+
+def has_variable(path, varname):
+    entry = file_info(path)
+    return entry is not None and varname in entry.get("variables", [])
+
+
+def res_entries(res_folder):
+    # All indexed files of a res folder (e.g. to plan runs for many glaciers), not checked for changes
+    return read_catalog(res_folder + "/" + CATALOG_NAME)
+
+
+def read_catalog(catalog_file):
+    if not os.path.exists(catalog_file):
+        return {}
+    mtime = os.stat(catalog_file).st_mtime_ns
+    if catalog_file not in _catalogs or _catalogs[catalog_file][0] != mtime:
+        with open(catalog_file, "r") as file:
+            _catalogs[catalog_file] = (mtime, json.load(file))
+    # Copy, so the cached content is not changed by update_catalog
+    return dict(_catalogs[catalog_file][1])
+
+
+def describe_file(path):
+    stat = os.stat(path)
+    entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": file_hash(path)}
+
+    if path.endswith(".nc"):
+        with xr.open_dataset(path, decode_times=False) as ds:
+            entry["variables"] = list(ds.data_vars)
+            entry["dims"] = {dim: int(size) for dim, size in ds.sizes.items()}
+            if "x" in ds.coords and ds.sizes["x"] > 1:
+                entry["resolution"] = abs(float(ds["x"][1] - ds["x"][0]))
+            if "time" in ds.coords and ds.sizes["time"] > 0:
+                time = ds["time"]
+                values = time.values[[0, -1]]
+                if "units" in time.attrs and "since" in time.attrs["units"]:
+                    values = cftime.num2date(values, time.attrs["units"], time.attrs.get("calendar", "standard"))
+                entry["time_range"] = [str(value) for value in values]
+
+    elif path.endswith(".json"):
+        with open(path, "r") as file:
+            content = json.load(file)
+        if isinstance(content, dict):
+            entry["keys"] = list(content.keys())
+
+    return entry
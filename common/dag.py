@@ -0,0 +1,112 @@
+# Make-like runner for the pipeline stages of one glacier
+# A stage is a dict:
+#   name: unique name, deps: names of the stages it depends on
+#   func, args: called in a worker process to build the stage
+#   inputs: files read besides the outputs of the dependencies (e.g. the stage script), params: other settings (JSON serializable)
+#   outputs: files written by the stage
+# A stage is rebuilt if the hash of its inputs changed or one of its outputs is missing or was modified
+# Stages whose dependencies are finished run in parallel, the state is kept in a JSON file
+
+import hashlib
+import json
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from common.utils import file_hash
+
+
+def run_dag(stages, state_file, n_processes=1, force=False):
+    state = load_state(state_file)
+    by_name = {stage["name"]: stage for stage in stages}
+
+    pending = list(stages)
+    running = {}
+    done = set()
+    failed = set()
+    errors = []
+
+    with ProcessPoolExecutor(max_workers=max(1, n_processes)) as executor:
+        while pending or running:
+            # Start all stages whose dependencies are finished (up-to-date stages finish at once)
+            progress = True
+            while progress:
+                progress = False
+                for stage in list(pending):
+                    if any(dep in failed for dep in stage["deps"]):
+                        print("Skipped " + stage["name"] + " (failed dependency)")
+                        pending.remove(stage)
+                        failed.add(stage["name"])
+                        progress = True
+                    elif all(dep in done for dep in stage["deps"]):
+                        pending.remove(stage)
+                        stage_hash = stage_inputs_hash(stage, by_name)
+                        if not force and is_up_to_date(state.get(stage["name"]), stage_hash):
+                            print("Up to date " + stage["name"])
+                            done.add(stage["name"])
+                            progress = True
+                        else:
+                            print("Building " + stage["name"])
+                            running[executor.submit(stage["func"], *stage["args"])] = (stage, stage_hash)
+
+            if not running:
+                if pending:
+                    raise ValueError("Cyclic or unknown dependencies: " + ", ".join(stage["name"] for stage in pending))
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, stage_hash = running.pop(future)
+                try:
+                    future.result()
+                    outputs = output_hashes(stage)
+                except Exception as error:
+                    errors.append((stage["name"], error))
+                    failed.add(stage["name"])
+                    state.pop(stage["name"], None)
+                else:
+                    done.add(stage["name"])
+                    state[stage["name"]] = {"inputs_hash": stage_hash, "outputs": outputs}
+                save_state(state_file, state)
+
+    if errors:
+        name, error = errors[0]
+        raise RuntimeError("Stage " + name + " failed (" + str(len(errors)) + " failed stages)") from error
+
+
+def stage_inputs_hash(stage, by_name):
+    files = {path: file_hash(path) for path in stage["inputs"]}
+    for dep in stage["deps"]:
+        for path in by_name[dep]["outputs"]:
+            files[path] = file_hash(path)
+    content = json.dumps({"files": files, "params": stage["params"]}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def output_hashes(stage):
+    missing = [path for path in stage["outputs"] if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError("Stage " + stage["name"] + " did not write: " + ", ".join(missing))
+    return {path: file_hash(path) for path in stage["outputs"]}
+
+
+def is_up_to_date(entry, stage_hash):
+    if entry is None or entry["inputs_hash"] != stage_hash:
+        return False
+    for path, expected in entry["outputs"].items():
+        if not os.path.exists(path) or file_hash(path) != expected:
+            return False
+    return True
+
+
+def load_state(state_file):
+    if not os.path.exists(state_file):
+        return {}
+    with open(state_file, "r") as file:
+        return json.load(file)
+
+
+def save_state(state_file, state):
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    with open(state_file + ".tmp", "w") as file:
+        json.dump(state, file, indent=4)
+    os.replace(state_file + ".tmp", state_file)
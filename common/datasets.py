@@ -0,0 +1,61 @@
+# Shared read access to the NetCDF files of the pipeline (gridded data, climate, SMB tables)
+# Files are opened lazily with dask chunks and only the variables a step needs are read
+# The open handles are kept in a small LRU per process and reused until the file changes (modification time and size)
+# Call release(path) before a file is overwritten
+
+import importlib.util
+import os
+from collections import OrderedDict
+import xarray as xr
+
+MAX_OPEN = 8
+
+# Chunks of the lazy datasets, the climate ensemble is stored with the same chunks (member x 1200 months)
+CHUNKS = {"member": 1, "time": 1200}
+DASK = importlib.util.find_spec("dask") is not None  # without dask the variables are still read on access only
+
+_handles = OrderedDict()  # (path, options) -> (mtime_ns, size, dataset)
+_pid = None  # handles are not shared with forked worker processes
+
+
+def open_dataset(path, variables=None, chunks=CHUNKS, **kwargs):
+    # Lazy dataset (do not close or load it, the handle is shared), kwargs are passed to xr.open_dataset
+    global _pid
+    if _pid != os.getpid():
+        _handles.clear()
+        _pid = os.getpid()
+
+    if not DASK:
+        chunks = None
+
+    path = os.path.abspath(path)
+    key = (path, repr(sorted(kwargs.items())), repr(chunks))
+    stat = os.stat(path)
+
+    if key in _handles and _handles[key][:2] == (stat.st_mtime_ns, stat.st_size):
+        _handles.move_to_end(key)
+        ds = _handles[key][2]
+    else:
+        if key in _handles:
+            _handles.pop(key)[2].close()
+        # Without dask, cache=False keeps xarray from filling the shared variables when values are read
+        ds = xr.open_dataset(path, chunks=chunks, cache=DASK, **kwargs)
+        _handles[key] = (stat.st_mtime_ns, stat.st_size, ds)
+        while len(_handles) > MAX_OPEN:
+            _handles.popitem(last=False)[1][2].close()
+
+    if variables is not None:
+        ds = ds[variables]
+    return ds
+
+
+def read_variables(path, variables, **kwargs):
+    # Variables in memory, the shared handle stays lazy (compute returns a copy, load would fill the shared variables)
+    return open_dataset(path, variables, **kwargs).compute()
+
+
+def release(path):
+    # Close all handles of a file, e.g. before it is written
+    path = os.path.abspath(path)
+    for key in [key for key in _handles if key[0] == path]:
+        _handles.pop(key)[2].close()
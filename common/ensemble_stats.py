@@ -0,0 +1,232 @@
+# Streaming statistics of the relative volume (volume / volume of the first year) of the forward runs of a glacier
+# Groups: all runs and the runs per factor level (thickness, calib, model), e.g. "calib=meltf_only"
+# Per group and year: count, mean and variance (Welford) and a histogram with fixed bins for the quantiles
+# Per group: time to 50% volume (Welford, min, max) and the number of runs which reach it
+# The accumulators have a fixed size (groups x years x bins), independent of the number of runs
+# They are kept in STATE_NAME next to the runs and updated when a run finishes (file lock), summarize creates SUMMARY_NAME
+# Only the runs which are done in the manifest of the result folder (common/manifest.py) are part of the statistics
+
+import os
+import numpy as np
+import xarray as xr
+
+from common.utils import file_lock
+from common.result_store import read_run_series
+
+STATE_NAME = "ensemble_stats_state.npz"
+SUMMARY_NAME = "ensemble_stats.nc"
+
+FACTORS = ["thickness", "calib", "model"]
+HIST_EDGES = np.linspace(0, 1.5, 76)  # relative volume, values above 1.5 are counted in the last bin
+QUANTILES = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+
+def add_run(state_file, thickness, calib, model, run_hash, run_file, start_year, end_year):
+    # A run which is already in the state is not added again (a repeated run with other inputs is detected by summarize)
+    series = read_run_series(run_file, model)
+    with file_lock(state_file + ".lock"):
+        state = load_state(state_file, start_year, end_year)
+        add_series(state, thickness, calib, model, run_hash, series)
+        save_state(state_file, state)
+
+
+def add_series(state, thickness, calib, model, run_hash, series):
+    key = thickness + "|" + calib + "|" + model
+    if key in state["run_keys"]:
+        return
+
+    labels = {"thickness": thickness, "calib": calib, "model": model}
+    rows = [group_row(state, "all")] + [group_row(state, factor + "=" + labels[factor]) for factor in FACTORS]
+    update(state, rows, series)
+    state["run_keys"] = np.append(state["run_keys"], key)
+    state["run_hashes"] = np.append(state["run_hashes"], run_hash)
+
+
+def summarize(out_folder, start_year, end_year, manifest):
+    # Summary of the state, which is rebuilt if its runs differ from the done runs of the manifest (missing, repeated with other inputs or failed since)
+    if not os.path.isdir(out_folder):
+        return
+    runs = done_runs(manifest)
+    state_file = out_folder + "/" + STATE_NAME
+    stale = not os.path.exists(state_file)
+    if not stale:
+        with np.load(state_file) as stored:
+            stale = dict(zip(stored["run_keys"], stored["run_hashes"])) != {key: entry["inputs_hash"] for key, entry in runs.items()}
+
+    if stale:
+        reduce_runs(out_folder, start_year, end_year, manifest)
+    else:
+        write_summary(state_file, out_folder + "/" + SUMMARY_NAME)
+
+
+def reduce_runs(out_folder, start_year, end_year, manifest):
+    # Rebuild the state from the output files of the done runs of the manifest ({run key: entry}, see common/manifest.py)
+    # Only one run is in memory at a time
+    state_file = out_folder + "/" + STATE_NAME
+
+    with file_lock(state_file + ".lock"):
+        state = load_state(None, start_year, end_year)
+        for key, entry in sorted(done_runs(manifest).items()):
+            thickness, calib, model = key.split("|")
+            series = read_run_series(entry["output"], model)
+            add_series(state, thickness, calib, model, entry["inputs_hash"], series)
+        if len(state["run_keys"]) == 0:
+            return
+        save_state(state_file, state)
+
+    write_summary(state_file, out_folder + "/" + SUMMARY_NAME)
+
+
+def done_runs(manifest):
+    # Manifest entries of the finished runs whose output file exists
+    return {key: entry for key, entry in manifest.items() if entry["status"] == "done" and os.path.exists(entry["output"])}
+
+
+def update(state, rows, series):
+    years = state["years"]
+    positions = np.searchsorted(years, series["time"])
+    valid = (positions < len(years)) & (years[np.minimum(positions, len(years) - 1)] == series["time"])
+
+    volume = np.full(len(years), np.nan)
+    volume[positions[valid]] = series["volume_m3"][valid]
+    finite = np.isfinite(volume)
+    if not finite.any() or volume[finite][0] <= 0:
+        return
+    relative = volume / volume[finite][0]
+
+    # Welford per year, only the years with values
+    for row in rows:
+        count = state["count"][row]
+        count[finite] += 1
+        delta = relative[finite] - state["mean"][row, finite]
+        state["mean"][row, finite] += delta / count[finite]
+        state["m2"][row, finite] += delta * (relative[finite] - state["mean"][row, finite])
+
+        bins = np.clip(np.searchsorted(HIST_EDGES, relative[finite], side="right") - 1, 0, len(HIST_EDGES) - 2)
+        state["hist"][row, np.flatnonzero(finite), bins] += 1
+
+        state["n_runs"][row] += 1
+
+    below = np.flatnonzero(finite & (relative <= 0.5))
+    if len(below) == 0:
+        return
+    t50 = float(years[below[0]] - years[np.flatnonzero(finite)[0]])
+    for row in rows:
+        state["t50_count"][row] += 1
+        delta = t50 - state["t50_mean"][row]
+        state["t50_mean"][row] += delta / state["t50_count"][row]
+        state["t50_m2"][row] += delta * (t50 - state["t50_mean"][row])
+        state["t50_min"][row] = min(state["t50_min"][row], t50)
+        state["t50_max"][row] = max(state["t50_max"][row], t50)
+
+
+def group_row(state, group):
+    # Index of a group, new groups are appended
+    if group in state["groups"]:
+        return list(state["groups"]).index(group)
+
+    n_years = len(state["years"])
+    empty = {
+        "count": np.zeros((1, n_years), dtype=np.int64),
+        "mean": np.zeros((1, n_years)),
+        "m2": np.zeros((1, n_years)),
+        "hist": np.zeros((1, n_years, len(HIST_EDGES) - 1), dtype=np.int32),
+        "n_runs": np.zeros(1, dtype=np.int64),
+        "t50_count": np.zeros(1, dtype=np.int64),
+        "t50_mean": np.zeros(1),
+        "t50_m2": np.zeros(1),
+        "t50_min": np.full(1, np.inf),
+        "t50_max": np.full(1, -np.inf),
+    }
+    for name, value in empty.items():
+        state[name] = np.concatenate([state[name], value])
+    state["groups"] = np.append(state["groups"], group)
+    return len(state["groups"]) - 1
+
+
+def load_state(state_file, start_year, end_year):
+    # state_file None: empty state
+    if state_file is not None and os.path.exists(state_file):
+        with np.load(state_file) as stored:
+            return {name: stored[name] for name in stored.files}
+
+    n_years = end_year - start_year + 1
+    return {
+        "years": np.arange(start_year, end_year + 1),
+        "groups": np.array([], dtype=str),
+        "run_keys": np.array([], dtype=str),
+        "run_hashes": np.array([], dtype=str),
+        "count": np.zeros((0, n_years), dtype=np.int64),
+        "mean": np.zeros((0, n_years)),
+        "m2": np.zeros((0, n_years)),
+        "hist": np.zeros((0, n_years, len(HIST_EDGES) - 1), dtype=np.int32),
+        "n_runs": np.zeros(0, dtype=np.int64),
+        "t50_count": np.zeros(0, dtype=np.int64),
+        "t50_mean": np.zeros(0),
+        "t50_m2": np.zeros(0),
+        "t50_min": np.zeros(0),
+        "t50_max": np.zeros(0),
+    }
+
+
+def save_state(state_file, state):
+    # Replace the file at once, so readers never see a half-written state
+    with open(state_file + ".tmp", "wb") as file:
+        np.savez_compressed(file, **state)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def write_summary(state_file, out):
+    with file_lock(state_file + ".lock"):
+        with np.load(state_file) as stored:
+            state = {name: stored[name] for name in stored.files}
+
+    count = state["count"]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean = np.where(count > 0, state["mean"], np.nan)
+        std = np.where(count > 1, np.sqrt(state["m2"] / (count - 1)), np.nan)
+        reached = state["t50_count"]
+        t50_mean = np.where(reached > 0, state["t50_mean"], np.nan)
+        t50_std = np.where(reached > 1, np.sqrt(state["t50_m2"] / (reached - 1)), np.nan)
+
+    factor, level = zip(*[group.split("=", 1) if "=" in group else (group, group) for group in state["groups"]])
+    ds = xr.Dataset(
+        {
+            "count": (["group", "year"], count),
+            "mean": (["group", "year"], mean),
+            "std": (["group", "year"], std),
+            "quantile_value": (["group", "quantile", "year"], histogram_quantiles(state["hist"], count)),
+            "n_runs": (["group"], state["n_runs"]),
+            "n_reached_50": (["group"], reached),
+            "time_to_50_mean": (["group"], t50_mean),
+            "time_to_50_std": (["group"], t50_std),
+            "time_to_50_min": (["group"], np.where(reached > 0, state["t50_min"], np.nan)),
+            "time_to_50_max": (["group"], np.where(reached > 0, state["t50_max"], np.nan)),
+        },
+        coords={
+            "group": list(state["groups"]),
+            "factor": (["group"], list(factor)),
+            "level": (["group"], list(level)),
+            "year": state["years"],
+            "quantile": QUANTILES,
+        },
+        attrs={"variable": "relative volume (volume / volume of the first year)", "time_to_50": "years until the volume is at most 50% of the first year"},
+    )
+    ds.to_netcdf(out + ".tmp")
+    os.replace(out + ".tmp", out)
+
+
+def histogram_quantiles(hist, count):
+    # Linear interpolation within the bins, groups x quantiles x years
+    cumulative = np.cumsum(hist, axis=-1)
+    values = np.full((hist.shape[0], len(QUANTILES), hist.shape[1]), np.nan)
+    for i, q in enumerate(QUANTILES):
+        target = q * count
+        index = np.minimum((cumulative < target[..., np.newaxis]).sum(axis=-1), hist.shape[-1] - 1)
+        before = np.take_along_axis(cumulative, index[..., np.newaxis], axis=-1)[..., 0] - np.take_along_axis(hist, index[..., np.newaxis], axis=-1)[..., 0]
+        in_bin = np.take_along_axis(hist, index[..., np.newaxis], axis=-1)[..., 0]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = np.clip(np.where(in_bin > 0, (target - before) / in_bin, 0), 0, 1)
+        quantile = HIST_EDGES[index] + fraction * (HIST_EDGES[index + 1] - HIST_EDGES[index])
+        values[:, i] = np.where(count > 0, quantile, np.nan)
+    return values
@@ -0,0 +1,116 @@
+# On-disk cache of OGGM preprocessed glacier directories
+# Entries are keyed by (RGI ID, prepro URL, level) and evicted least recently used if the cache grows too large
+# Every caller gets its own copy of the gdir, files which are never modified are hardlinked instead of copied
+# The cache can be pre-seeded (seed_cache) and used offline (GLACIER_CACHE_OFFLINE=1 never downloads)
+
+import hashlib
+import json
+import os
+import shutil
+import time
+import oggm.cfg as cfg
+import oggm.utils as utils
+import oggm.workflow as workflow
+
+from common.utils import file_lock, gdir_path
+
+CACHE_DIR = os.environ.get("GLACIER_CACHE_DIR", os.path.expanduser("~/.cache/glacier-projections/gdirs"))
+CACHE_MAX_BYTES = int(os.environ.get("GLACIER_CACHE_MAX_BYTES", 10 * 1024**3))
+OFFLINE = os.environ.get("GLACIER_CACHE_OFFLINE", "0") == "1"
+
+# None of the stages writes to these files, so they can be shared with the cache
+LINKED_FILES = ["climate_historical.nc", "dem.tif", "outlines.tar.gz", "intersects.tar.gz"]
+
+
+def init_cached_gdir(rgi_id, prepro_base_url, from_prepro_level):
+    # Replaces workflow.init_glacier_directories(rgi_id, prepro_base_url, from_prepro_level, reset=True, force=True)[0]
+    # The copy is placed in the current cfg.PATHS["working_dir"]
+    entry = cache_entry(rgi_id, prepro_base_url, from_prepro_level)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with file_lock(entry + ".lock"):
+        if not os.path.exists(entry + "/meta.json"):  # written last
+            if OFFLINE:
+                raise RuntimeError("No cached gdir for " + rgi_id + " (level " + str(from_prepro_level) + ") and offline mode is enabled")
+            download_to_cache(entry, rgi_id, prepro_base_url, from_prepro_level)
+
+        base_dir = cfg.PATHS["working_dir"] + "/per_glacier"
+        target = gdir_path(base_dir, rgi_id)
+        if os.path.exists(target):
+            shutil.rmtree(target)
+        shutil.copytree(entry + "/gdir", target, copy_function=link_or_copy)
+
+        # Mark as recently used
+        os.utime(entry + "/meta.json")
+
+    evict()
+
+    return utils.GlacierDirectory(rgi_id, base_dir=base_dir)
+
+
+def cache_entry(rgi_id, prepro_base_url, from_prepro_level):
+    key = hashlib.sha256((rgi_id + "|" + prepro_base_url + "|" + str(from_prepro_level)).encode()).hexdigest()
+    return CACHE_DIR + "/" + key[:24]
+
+
+def download_to_cache(entry, rgi_id, prepro_base_url, from_prepro_level):
+    # Download into a temporary working dir and move the gdir into the cache entry
+    working_dir = cfg.PATHS["working_dir"]
+    temp_wd = entry + ".download"
+    try:
+        cfg.PATHS["working_dir"] = temp_wd
+        gdir = workflow.init_glacier_directories(rgi_id, prepro_base_url=prepro_base_url, from_prepro_level=from_prepro_level, reset=True, force=True)[0]
+        seed_cache(gdir.dir, rgi_id, prepro_base_url, from_prepro_level)
+    finally:
+        cfg.PATHS["working_dir"] = working_dir
+        if os.path.exists(temp_wd):
+            shutil.rmtree(temp_wd)
+
+
+def seed_cache(gdir_dir, rgi_id, prepro_base_url, from_prepro_level):
+    # Add an existing (unmodified) gdir to the cache, e.g. to prepare an offline store
+    entry = cache_entry(rgi_id, prepro_base_url, from_prepro_level)
+    if os.path.exists(entry):
+        shutil.rmtree(entry)
+    os.makedirs(entry)
+    shutil.copytree(gdir_dir, entry + "/gdir")
+
+    meta = {"rgi_id": rgi_id, "prepro_base_url": prepro_base_url, "from_prepro_level": from_prepro_level, "created": time.time()}
+    with open(entry + "/meta.json", "w") as file:
+        json.dump(meta, file, indent=4)
+
+
+def link_or_copy(src, dst):
+    if os.path.basename(src) in LINKED_FILES:
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass  # e.g. other file system
+    return shutil.copy2(src, dst)
+
+
+def evict():
+    # Remove the least recently used entries until the cache fits into CACHE_MAX_BYTES
+    with file_lock(CACHE_DIR + "/.evict.lock"):
+        entries = []
+        for name in os.listdir(CACHE_DIR):
+            meta_file = CACHE_DIR + "/" + name + "/meta.json"
+            if os.path.exists(meta_file):
+                entries.append((os.path.getmtime(meta_file), folder_size(CACHE_DIR + "/" + name), CACHE_DIR + "/" + name))
+
+        total = sum(entry[1] for entry in entries)
+        for last_used, size, entry in sorted(entries)[:-1]:  # never remove the most recent one
+            if total <= CACHE_MAX_BYTES:
+                break
+            with file_lock(entry + ".lock"):
+                shutil.rmtree(entry)
+            total -= size
+
+
+def folder_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for file in files:
+            size += os.path.getsize(os.path.join(root, file))
+    return size
@@ -0,0 +1,57 @@
+# Run IGM either in the long-lived worker process (forward-runs/igm_forward/igm_worker.py)
+# or as a new igm_run.sh process per run, both return the same result dict:
+# {"returncode": int, "stdout": str, "stderr": str, "output": str}
+
+import os
+import subprocess
+import tempfile
+import time
+import uuid
+from multiprocessing.connection import Client
+
+from common.utils import save_json_to_file
+
+
+class IGMWorker:
+    def __init__(self, worker_sh, start_timeout=300):
+        # Short socket path in the temp dir (unix sockets are limited to ~100 characters)
+        self.socket_path = os.path.join(tempfile.gettempdir(), "igm_worker_" + uuid.uuid4().hex[:12] + ".sock")
+        self.process = subprocess.Popen([os.path.abspath(worker_sh), self.socket_path])
+        self.connection = None
+
+        # Wait until the worker listens (conda activation and TensorFlow import)
+        deadline = time.time() + start_timeout
+        while self.connection is None:
+            if self.process.poll() is not None:
+                raise RuntimeError("IGM worker exited with return code " + str(self.process.returncode))
+            try:
+                self.connection = Client(self.socket_path, family="AF_UNIX")
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() > deadline:
+                    self.process.kill()
+                    raise RuntimeError("IGM worker did not start within " + str(start_timeout) + " s")
+                time.sleep(0.5)
+
+    def run(self, params, cwd):
+        self.connection.send({"params": params, "cwd": os.path.abspath(cwd)})
+        return self.connection.recv()
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.send({"stop": True})
+            except OSError:
+                pass  # worker is already gone
+            self.connection.close()
+            self.connection = None
+        self.process.wait()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def run_igm_subprocess(igm_run_sh, params, cwd):
+    params_file = os.path.join(os.path.abspath(cwd), "params_run.json")
+    save_json_to_file(params, params_file)
+
+    result = subprocess.run([os.path.abspath(igm_run_sh), params_file], cwd=cwd, capture_output=True, text=True)
+    return {"returncode": result.returncode, "stdout": result.stdout, "stderr": result.stderr, "output": params.get("wts_output_file")}
@@ -0,0 +1,126 @@
+# Timing and resource records of the pipeline stages and forward runs
+# Every instrumented block appends one JSON line to LOG_DIR/RGI_ID.jsonl:
+#   name and labels, start, wall_s, cpu_s (this process), cpu_children_s (finished subprocesses),
+#   peak_rss_mib / peak_rss_children_mib (maximum of the process so far), read_bytes / write_bytes (I/O calls, /proc/self/io),
+#   status ("ok" or "failed") and everything the block adds to the record (e.g. returncode)
+# Nested blocks inherit the RGI ID and store the name of their parent
+# Profiling of the outermost blocks: GLACIER_PROFILE=cprofile or GLACIER_PROFILE=py-spy, results in LOG_DIR/profiles
+
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import signal
+import subprocess
+import time
+
+from common.utils import file_lock
+
+LOG_DIR = os.environ.get("GLACIER_LOG_DIR", "logs")
+PROFILE = os.environ.get("GLACIER_PROFILE", "")
+
+_active = []  # records of the open blocks of this process
+_profiler_failed = False  # py-spy could not be started, the blocks run without profiling
+
+
+@contextlib.contextmanager
+def instrument(name, rgi_id=None, **labels):
+    parent = _active[-1] if _active else None
+    if rgi_id is None:
+        rgi_id = parent["rgi_id"] if parent is not None else "unknown"
+
+    record = {"rgi_id": rgi_id, "name": name}
+    record.update(labels)
+    if parent is not None:
+        record["parent"] = parent["name"]
+
+    profiler = start_profiler(record) if parent is None else None
+    start = time.perf_counter()
+    times = os.times()
+    io = read_io()
+    record["start"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    record["pid"] = os.getpid()
+    record["status"] = "ok"
+
+    _active.append(record)
+    try:
+        yield record
+    except BaseException:
+        record["status"] = "failed"
+        raise
+    finally:
+        _active.pop()
+        record["wall_s"] = time.perf_counter() - start
+        end_times = os.times()
+        record["cpu_s"] = (end_times.user + end_times.system) - (times.user + times.system)
+        record["cpu_children_s"] = (end_times.children_user + end_times.children_system) - (times.children_user + times.children_system)
+        record["peak_rss_mib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # KiB on Linux
+        record["peak_rss_children_mib"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+        end_io = read_io()
+        if io is not None and end_io is not None:
+            record["read_bytes"] = end_io["rchar"] - io["rchar"]
+            record["write_bytes"] = end_io["wchar"] - io["wchar"]
+        stop_profiler(profiler)
+        write_record(record)
+
+
+def annotate(**values):
+    # Add values to the record of the innermost open block (no effect outside of a block)
+    if _active:
+        _active[-1].update(values)
+
+
+def read_io():
+    # Linux only, None elsewhere
+    try:
+        with open("/proc/self/io", "r") as file:
+            return {key: int(value) for key, value in (line.split(":") for line in file)}
+    except OSError:
+        return None
+
+
+def write_record(record):
+    os.makedirs(LOG_DIR, exist_ok=True)
+    log_file = LOG_DIR + "/" + record["rgi_id"] + ".jsonl"
+    with file_lock(log_file + ".lock"):
+        with open(log_file, "a") as file:
+            file.write(json.dumps(record, default=str) + "\n")
+
+
+def start_profiler(record):
+    global _profiler_failed
+    if PROFILE not in ["cprofile", "py-spy"] or _profiler_failed:
+        return None
+
+    os.makedirs(LOG_DIR + "/profiles", exist_ok=True)
+    labels = [str(value) for key, value in record.items() if key not in ["rgi_id", "name"]]
+    out = LOG_DIR + "/profiles/" + "_".join([record["rgi_id"], record["name"]] + labels + [str(os.getpid())])
+
+    if PROFILE == "cprofile":
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return {"type": "cprofile", "profiler": profiler, "out": out + ".prof"}
+
+    # py-spy samples this process from outside (it has to be installed and allowed to attach)
+    # Without it the pipeline runs unprofiled, a profiling hook must not fail a stage
+    try:
+        process = subprocess.Popen(["py-spy", "record", "--pid", str(os.getpid()), "--subprocesses", "-o", out + ".svg"])
+    except OSError as error:
+        _profiler_failed = True
+        print("Profiling disabled, py-spy could not be started: " + str(error))
+        return None
+    return {"type": "py-spy", "process": process, "out": out + ".svg"}
+
+
+def stop_profiler(profiler):
+    if profiler is None:
+        return
+
+    if profiler["type"] == "cprofile":
+        profiler["profiler"].disable()
+        profiler["profiler"].dump_stats(profiler["out"])
+    else:
+        # py-spy writes its output when it is interrupted
+        profiler["process"].send_signal(signal.SIGINT)
+        profiler["process"].wait()
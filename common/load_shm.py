@@ -0,0 +1,48 @@
+# IGM module (runs inside the IGM environment): loads the input grids from the .npy files of a descriptor (common/shm_grids.py)
+# Replaces load_ncdf in "modules_preproc", the files are memory mapped, so files in /dev/shm are not read from disk
+# Copied into the run directory as load_shm.py by shm_grids.use_shm_input
+
+import json
+import os
+import numpy as np
+import tensorflow as tf
+
+
+def params(parser):
+    parser.add_argument("--lshm_descriptor", type=str, default="descriptor.json", help="Descriptor (JSON) of the input grids")
+
+
+def initialize(params, state):
+    with open(params.lshm_descriptor, "r") as file:
+        descriptor = json.load(file)
+    folder = os.path.dirname(os.path.abspath(params.lshm_descriptor))
+
+    def load(name):
+        return np.load(folder + "/" + name, mmap_mode="r")
+
+    x = load(descriptor["x"])
+    y = load(descriptor["y"])
+
+    # Same state as after load_ncdf: coordinates (y increasing), grid spacing and the fields as non-trainable variables
+    flip = y[0] > y[-1]
+    state.x = tf.constant(np.array(x, dtype="float32"))
+    state.y = tf.constant(np.array(y[::-1] if flip else y, dtype="float32"))
+    state.X, state.Y = tf.meshgrid(state.x, state.y)
+    state.dx = state.x[1] - state.x[0]
+    state.dX = tf.ones_like(state.X) * state.dx
+
+    for name, file in descriptor["variables"].items():
+        values = load(file)
+        values = values[::-1] if flip else values
+        vars(state)[name] = tf.Variable(np.array(values, dtype="float32"), trainable=False)
+
+    if not hasattr(state, "topg"):
+        state.topg = tf.Variable(state.usurf - state.thk, trainable=False)
+
+
+def update(params, state):
+    pass
+
+
+def finalize(params, state):
+    pass
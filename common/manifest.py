@@ -0,0 +1,47 @@
+# Manifest of the forward runs in a result folder (manifest.json)
+# For every run (thickness, calib, model) it stores the hash of the run inputs, the output file and the status
+# A run is up to date if it finished with the same inputs hash and its output file still exists
+# Updates are serialized with a file lock, so parallel workers can record their runs
+
+import hashlib
+import json
+import os
+import time
+
+from common.utils import file_lock
+
+
+def run_key(thickness, calib, model):
+    return thickness + "|" + calib + "|" + model
+
+
+def inputs_hash(file_hashes, settings):
+    # file_hashes: hashes of the input files, settings: everything else the run depends on (JSON serializable)
+    content = json.dumps({"files": file_hashes, "settings": settings}, sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+def load_manifest(manifest_file):
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r") as file:
+        return json.load(file)
+
+
+def is_up_to_date(manifest, key, run_hash):
+    entry = manifest.get(key)
+    if entry is None:
+        return False
+    return entry["status"] == "done" and entry["inputs_hash"] == run_hash and os.path.exists(entry["output"])
+
+
+def record_run(manifest_file, key, run_hash, output, status):
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    with file_lock(manifest_file + ".lock"):
+        manifest = load_manifest(manifest_file)
+        manifest[key] = {"inputs_hash": run_hash, "output": output, "status": status, "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+        # Replace the file at once, so readers never see a half-written manifest
+        with open(manifest_file + ".tmp", "w") as file:
+            json.dump(manifest, file, indent=4)
+        os.replace(manifest_file + ".tmp", manifest_file)
@@ -0,0 +1,70 @@
+# Compact representation of the glacier cells of a grid
+# Most cells of the gridded data lie outside the glacier mask, so operations work on
+#   bbox: bounding box (slices) of the mask
+#   index: flat indices of the mask cells inside the bounding box
+# Full grids are only created by expand, when the data is written
+
+import numpy as np
+import scipy
+
+
+def masked_grid(mask):
+    mask = np.asarray(mask) != 0
+    rows = np.flatnonzero(mask.any(axis=1))
+    cols = np.flatnonzero(mask.any(axis=0))
+    if len(rows) == 0:
+        bbox = (slice(0, 0), slice(0, 0))
+    else:
+        bbox = (slice(rows[0], rows[-1] + 1), slice(cols[0], cols[-1] + 1))
+    return {"shape": mask.shape, "bbox": bbox, "index": np.flatnonzero(mask[bbox])}
+
+
+def compress(grid, values):
+    # Values of the mask cells (1D)
+    return np.asarray(values)[grid["bbox"]].ravel()[grid["index"]]
+
+
+def expand(grid, compressed, fill, dtype=None):
+    # Full grid with the compressed values in the mask cells and fill elsewhere
+    dtype = compressed.dtype if dtype is None else dtype
+    crop = np.full(bbox_shape(grid), fill, dtype=dtype)
+    crop.ravel()[grid["index"]] = compressed
+    full = np.full(grid["shape"], fill, dtype=dtype)
+    full[grid["bbox"]] = crop
+    return full
+
+
+def bbox_shape(grid):
+    return tuple(s.stop - s.start for s in grid["bbox"])
+
+
+def masked_zero_medfilt(grid, values):
+    # medfilt2d (3x3) of values set to 0 outside the mask
+    # Only the bounding box plus a margin of two cells is filtered, the result equals the full-grid filter:
+    # cells further out only have zero neighbours, and no cell next to the mask lies on the border of the window
+    # (medfilt2d orders the padded border windows differently, which matters for NaN velocities)
+    values = np.asarray(values)
+    window = tuple(slice(max(s.start - 2, 0), min(s.stop + 2, n)) for s, n in zip(grid["bbox"], grid["shape"]))
+    inner = tuple(slice(s.start - w.start, s.stop - w.start) for s, w in zip(grid["bbox"], window))
+
+    box = np.zeros(bbox_shape(grid), dtype=values.dtype)
+    box.ravel()[grid["index"]] = compress(grid, values)
+    crop = np.zeros(tuple(w.stop - w.start for w in window), dtype=values.dtype)
+    crop[inner] = box
+
+    full = np.zeros(grid["shape"], dtype=values.dtype)
+    if crop.size > 0:
+        full[window] = scipy.signal.medfilt2d(crop, kernel_size=3)
+    return full
+
+
+def thickness_stats(grid, thickness, dx):
+    # Statistics of the mask cells, NaN thickness counts as ice free
+    values = np.nan_to_num(compress(grid, thickness).astype(float))
+    cell_area = dx * dx
+    return {
+        "area_m2": len(values) * cell_area,
+        "volume_m3": float(values.sum() * cell_area),
+        "mean_thickness": float(values.mean()) if len(values) > 0 else 0.0,
+        "max_thickness": float(values.max()) if len(values) > 0 else 0.0,
+    }
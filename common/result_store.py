@@ -0,0 +1,82 @@
+# Single NetCDF4 store for the volume, area and length evolution of all forward runs
+# Dimensions: glacier x thickness x model x calib x time, one chunk per run (time series)
+# The label dimensions are unlimited, new glaciers, thicknesses, models or calibrations are appended when they occur
+# Writes are serialized with a file lock, so parallel workers can append their runs
+# Read it lazily with open_store (dask)
+
+import os
+import netCDF4
+import numpy as np
+import xarray as xr
+
+from common.utils import file_lock
+
+LABEL_DIMS = ["glacier", "thickness", "model", "calib"]
+
+# Variables of the store and their names in the OGGM / IGM output files (with unit conversion)
+VARIABLES = {
+    "volume_m3": {"oggm": ("volume_m3", 1), "igm": ("vol", 1e9)},  # IGM: km^3
+    "area_m2": {"oggm": ("area_m2", 1), "igm": ("area", 1e6)},  # IGM: km^2
+    "length_m": {"oggm": ("length_m", 1)},  # not in the IGM output
+}
+
+
+def append_run(store_file, run_file, rgi_id, thickness, model, calib, start_year, end_year):
+    series = read_run_series(run_file, model)
+    labels = {"glacier": rgi_id, "thickness": thickness, "model": model, "calib": calib}
+
+    with file_lock(store_file + ".lock"):
+        if not os.path.exists(store_file):
+            create_store(store_file, start_year, end_year)
+
+        with netCDF4.Dataset(store_file, "a") as nc:
+            index = tuple(label_index(nc, dim, labels[dim]) for dim in LABEL_DIMS)
+
+            # Match the years of the run to the time axis of the store
+            store_years = nc["time"][:]
+            positions = np.searchsorted(store_years, series["time"])
+            valid = (positions < len(store_years)) & (store_years[np.minimum(positions, len(store_years) - 1)] == series["time"])
+
+            for var in VARIABLES:
+                values = np.full(len(store_years), np.nan)
+                if var in series:
+                    values[positions[valid]] = series[var][valid]
+                nc[var][index] = values
+
+
+def create_store(store_file, start_year, end_year):
+    with netCDF4.Dataset(store_file, "w", format="NETCDF4") as nc:
+        for dim in LABEL_DIMS:
+            nc.createDimension(dim, None)
+            nc.createVariable(dim, str, (dim,))
+
+        years = np.arange(start_year, end_year + 1)
+        nc.createDimension("time", len(years))
+        nc.createVariable("time", "i4", ("time",))[:] = years
+
+        for var in VARIABLES:
+            nc.createVariable(var, "f8", LABEL_DIMS + ["time"], zlib=True, complevel=4, fill_value=np.nan, chunksizes=(1, 1, 1, 1, len(years)))
+
+
+def label_index(nc, dim, label):
+    labels = list(nc[dim][:]) if len(nc.dimensions[dim]) > 0 else []
+    if label in labels:
+        return labels.index(label)
+    nc[dim][len(labels)] = label
+    return len(labels)
+
+
+def read_run_series(run_file, model):
+    # Time series of a run file in the units of the store
+    source = "igm" if model == "igm" else "oggm"
+    with xr.open_dataset(run_file) as ds:
+        series = {"time": np.round(ds["time"].values).astype(int)}
+        for var, names in VARIABLES.items():
+            if source in names:
+                name, factor = names[source]
+                series[var] = ds[name].values.astype(float) * factor
+    return series
+
+
+def open_store(store_file):
+    return xr.open_dataset(store_file, chunks={})
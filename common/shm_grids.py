@@ -0,0 +1,45 @@
+# IGM input grids as .npy files with a JSON descriptor, read by the IGM module common/load_shm.py instead of load_ncdf
+# In /dev/shm the files stay in memory and IGM maps them, no NetCDF file is encoded and decoded per run
+# Descriptor: {"x": "x.npy", "y": "y.npy", "variables": {name: "name.npy"}}, file names relative to the descriptor
+
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+SHM_DIR = ("/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()) + "/glacier-projections"
+LOAD_SHM_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "load_shm.py")
+DESCRIPTOR_NAME = "descriptor.json"
+
+
+def write_grids(ds_igm, folder):
+    # float32 as in load_ncdf, the folder is written completely before it is moved to its name
+    if os.path.exists(folder + ".tmp"):
+        shutil.rmtree(folder + ".tmp")
+    os.makedirs(folder + ".tmp")
+
+    descriptor = {"x": "x.npy", "y": "y.npy", "variables": {}}
+    for name in ["x", "y"]:
+        np.save(folder + ".tmp/" + name + ".npy", ds_igm[name].values.astype(np.float32))
+    for name, var in ds_igm.data_vars.items():
+        if var.dims == ("y", "x"):
+            np.save(folder + ".tmp/" + name + ".npy", var.values.astype(np.float32))
+            descriptor["variables"][name] = name + ".npy"
+
+    with open(folder + ".tmp/" + DESCRIPTOR_NAME, "w") as file:
+        json.dump(descriptor, file, indent=4)
+    os.replace(folder + ".tmp", folder)
+    return folder + "/" + DESCRIPTOR_NAME
+
+
+def is_descriptor(igm_input):
+    return igm_input.endswith(DESCRIPTOR_NAME)
+
+
+def use_shm_input(params, descriptor_file, run_dir):
+    # IGM imports custom modules from the CWD (the run directory)
+    shutil.copy(LOAD_SHM_MODULE, run_dir + "/load_shm.py")
+    params["modules_preproc"] = ["load_shm" if module == "load_ncdf" else module for module in params["modules_preproc"]]
+    params.pop("lncd_input_file", None)
+    params["lshm_descriptor"] = os.path.abspath(descriptor_file)
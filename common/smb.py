@@ -0,0 +1,140 @@
+# Temperature-index surface mass balance (SMB) tables: SMB(calib, elevation, year) in kg m-2 yr-1
+# Same model as OGGM's MonthlyTIModel with the parameters of the calibration files (mb_calib.json):
+#   temp(z) = temp + temp_bias + temp_default_gradient * (z - ref_hgt)
+#   melt = melt_f * 365 / 12 * max(temp(z) - temp_melt, 0)
+#   solid prcp = prcp * prcp_fac * solid fraction (1 below temp_all_solid, 0 above temp_all_liq, linear in between)
+#   SMB = sum of the monthly (solid prcp - melt) - bias
+# All calibrations and elevations are evaluated at once, the tables are cached per calibration and reused until an input changes
+
+import hashlib
+import json
+import os
+import shutil
+import cftime
+import numpy as np
+import xarray as xr
+
+from common.utils import file_hash
+from common.datasets import open_dataset
+
+ELEVATION_STEP = 10.0  # m
+IGM_SMB_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "smb_table.py")
+BLOCK_YEARS = 100  # years evaluated at once (memory: calibs x elevations x 12 * BLOCK_YEARS values)
+
+
+def smb_tables(climate_file, calib_files, gridded_data_file, out_dir):
+    # calib_files: {calib: JSON file}, returns {calib: table file}
+    elevations = elevation_grid(gridded_data_file)
+    source_hash = hashlib.sha256((file_hash(climate_file) + str(elevations[0]) + str(elevations[-1]) + str(ELEVATION_STEP)).encode()).hexdigest()
+    files = {}
+    for calib, calib_file in calib_files.items():
+        key = hashlib.sha256((source_hash + file_hash(calib_file)).encode()).hexdigest()[:16]
+        files[calib] = out_dir + "/smb_" + calib + "_" + key + ".nc"
+
+    missing = [calib for calib in calib_files if not os.path.exists(files[calib])]
+    if not missing:
+        return files
+
+    # Remove tables of previous inputs
+    os.makedirs(out_dir, exist_ok=True)
+    for calib in missing:
+        for file in os.listdir(out_dir):
+            if file.startswith("smb_" + calib + "_"):
+                os.remove(out_dir + "/" + file)
+
+    params = [load_calib(calib_files[calib]) for calib in missing]
+    years, table = ti_smb_table(climate_file, params, elevations)
+
+    for i, calib in enumerate(missing):
+        ds = xr.Dataset(
+            {"smb": (["elevation", "year"], table[i], {"units": "kg m-2 yr-1"})},
+            coords={"elevation": elevations, "year": years},
+            attrs={"calib": calib},
+        )
+        # Write to a temporary file first, so no half-written table is reused
+        ds.to_netcdf(files[calib] + ".tmp")
+        os.replace(files[calib] + ".tmp", files[calib])
+
+    return files
+
+
+def use_smb_table(params, table_file, run_dir):
+    # IGM takes the SMB from the table (IGM module common/smb_table.py) instead of clim_oggm and smb_oggm
+    # IGM imports custom modules from the CWD (the run directory)
+    shutil.copy(IGM_SMB_MODULE, run_dir + "/smb_table.py")
+    modules = []
+    for module in params["modules_process"]:
+        if module in ["clim_oggm", "smb_oggm"]:
+            module = "smb_table"
+        if module not in modules:
+            modules.append(module)
+    params["modules_process"] = modules
+    for name in ["smb_mb_calib_file", "clim_mb_calib_file", "clim_forward_climate_file"]:
+        params.pop(name, None)
+    params["smbt_table_file"] = os.path.abspath(table_file)
+
+
+def elevation_grid(gridded_data_file, step=ELEVATION_STEP):
+    # Covers the whole DEM of the glacier grid
+    topo = open_dataset(gridded_data_file, ["topo"])["topo"].values
+    low = np.floor(np.nanmin(topo) / step) * step
+    high = np.ceil(np.nanmax(topo) / step) * step
+    return np.arange(low, high + step / 2, step)
+
+
+def load_calib(calib_file):
+    with open(calib_file, "r") as file:
+        calib = json.load(file)
+    global_params = calib["mb_global_params"]
+    return {
+        "melt_f": calib["melt_f"],
+        "prcp_fac": calib["prcp_fac"],
+        "temp_bias": calib["temp_bias"],
+        "bias": calib.get("bias", 0),
+        "temp_default_gradient": global_params["temp_default_gradient"],
+        "temp_all_solid": global_params["temp_all_solid"],
+        "temp_all_liq": global_params["temp_all_liq"],
+        "temp_melt": global_params["temp_melt"],
+    }
+
+
+def ti_smb_table(climate_file, params, elevations):
+    # Returns the years and the table (calib x elevation x year)
+    ds = open_dataset(climate_file, ["temp", "prcp"], decode_times=False)
+    temp = ds["temp"].values
+    prcp = ds["prcp"].values
+    ref_hgt = ds.attrs["ref_hgt"]
+    first = cftime.num2date(ds["time"].values[0], ds["time"].attrs["units"], ds["time"].attrs.get("calendar", "standard"))
+
+    if first.month != 1 or len(temp) % 12 != 0:
+        raise ValueError("The climate file has to consist of complete years: " + climate_file)
+    n_years = len(temp) // 12
+    years = first.year + np.arange(n_years)
+
+    # calib x 1 x 1 parameters, broadcast against elevation x month
+    def param(name):
+        return np.array([p[name] for p in params], dtype=float)[:, np.newaxis, np.newaxis]
+
+    dz = (elevations - ref_hgt)[np.newaxis, :, np.newaxis]
+    temp_offset = param("temp_bias") + param("temp_default_gradient") * dz
+    monthly_melt_f = param("melt_f") * 365 / 12
+    prcp_fac = param("prcp_fac")
+    temp_melt = param("temp_melt")
+    temp_all_solid = param("temp_all_solid")
+    temp_all_liq = param("temp_all_liq")
+
+    table = np.empty((len(params), len(elevations), n_years))
+    for start in range(0, n_years, BLOCK_YEARS):
+        stop = min(start + BLOCK_YEARS, n_years)
+        months = slice(start * 12, stop * 12)
+
+        temp_z = temp[np.newaxis, np.newaxis, months] + temp_offset
+        melt = monthly_melt_f * np.maximum(temp_z - temp_melt, 0)
+        solid_fraction = np.clip((temp_all_liq - temp_z) / (temp_all_liq - temp_all_solid), 0, 1)
+        solid_prcp = prcp[np.newaxis, np.newaxis, months] * prcp_fac * solid_fraction
+
+        monthly = solid_prcp - melt
+        table[:, :, start:stop] = monthly.reshape(len(params), len(elevations), stop - start, 12).sum(axis=-1)
+
+    table -= param("bias")
+    return years, table
@@ -0,0 +1,43 @@
+# IGM module (runs inside the IGM environment): SMB from a table of common/smb.py (elevation x year, kg m-2 yr-1)
+# Replaces clim_oggm and smb_oggm in "modules_process", the SMB of the current year is interpolated on usurf once per year
+# Copied into the run directory as smb_table.py by smb.use_smb_table
+
+import numpy as np
+import tensorflow as tf
+import xarray as xr
+
+
+def params(parser):
+    parser.add_argument("--smbt_table_file", type=str, default="smb_table.nc", help="SMB table (elevation x year, kg m-2 yr-1)")
+    parser.add_argument("--smbt_ice_density", type=float, default=900.0, help="Ice density (kg m-3), as in OGGM")
+
+
+def initialize(params, state):
+    with xr.open_dataset(params.smbt_table_file) as ds:
+        state.smbt_elevations = ds["elevation"].values
+        state.smbt_first_year = int(ds["year"].values[0])
+        state.smbt_table = ds["smb"].values
+    state.smbt_year = None
+    state.smb = tf.zeros_like(state.thk)
+
+
+def update(params, state):
+    year = int(np.floor(float(state.t)))
+    if year == state.smbt_year:
+        return
+    state.smbt_year = year
+
+    index = year - state.smbt_first_year
+    if not 0 <= index < state.smbt_table.shape[1]:
+        raise ValueError("Year " + str(year) + " is not in the SMB table " + params.smbt_table_file)
+    column = state.smbt_table[:, index]
+    smb = np.interp(state.usurf.numpy(), state.smbt_elevations, column) / params.smbt_ice_density  # m ice eq. yr-1
+
+    # As smb_oggm: no accumulation outside the ice mask
+    if hasattr(state, "icemask"):
+        smb = np.where((smb < 0) | (state.icemask.numpy() > 0.5), smb, -10)
+    state.smb = tf.constant(smb.astype("float32"))
+
+
+def finalize(params, state):
+    pass
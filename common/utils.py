@@ -1,13 +1,22 @@
 # utitlity functions
 
+import contextlib
+import fcntl
+import hashlib
 import json
 import os
 import re
 import shutil
 import numpy as np
-import scipy
 import xarray as xr
 
+from common.masked_grid import compress, expand, masked_grid, masked_zero_medfilt
+from common.datasets import read_variables
+from common.shm_grids import write_grids
+
+# Variables of the OGGM gridded data needed for the IGM input files (besides the thickness)
+IGM_SOURCE_VARIABLES = ["topo", "glacier_mask", "millan_vx", "millan_vy", "hugonnet_dhdt"]
+
 # Helpers
 
 
@@ -25,8 +34,52 @@ def save_json_to_file(data, filename):
 
 
 def oggm_nc_to_igm_nc(oggm_nc_file, igm_nc_file, thickness = "consensus_ice_thickness"):
-    ds_oggm = xr.open_dataset(oggm_nc_file, mode="r+")
+    ds_oggm = read_variables(oggm_nc_file, IGM_SOURCE_VARIABLES + [thickness])
+    ds_igm = oggm_ds_to_igm_ds(ds_oggm, thickness)
+
+    # Store input file for IGM inversion
+    if os.path.exists(igm_nc_file):
+        os.remove(igm_nc_file)
+    ds_igm.to_netcdf(igm_nc_file)
+
+
+def igm_inputs(oggm_nc_file, thicknesses, out_dir, shm=False):
+    # IGM input files for several thicknesses from a single read of the OGGM file
+    # The files are named after the hash of the OGGM file and reused until it changes
+    # shm: .npy grids with a descriptor per thickness (common/shm_grids.py) instead of NetCDF files
+    source_hash = file_hash(oggm_nc_file)[:16]
+    if shm:
+        files = {thickness: out_dir + "/igm_input_" + thickness + "_" + source_hash + "/descriptor.json" for thickness in thicknesses}
+    else:
+        files = {thickness: out_dir + "/igm_input_" + thickness + "_" + source_hash + ".nc" for thickness in thicknesses}
+
+    missing = [thickness for thickness in thicknesses if not os.path.exists(files[thickness])]
+    if not missing:
+        return files
+
+    # Remove files of previous versions of the OGGM file
+    os.makedirs(out_dir, exist_ok=True)
+    for file in os.listdir(out_dir):
+        if file.startswith("igm_input_") and not os.path.splitext(file)[0].endswith("_" + source_hash):
+            if os.path.isdir(out_dir + "/" + file):
+                shutil.rmtree(out_dir + "/" + file)
+            else:
+                os.remove(out_dir + "/" + file)
+
+    ds_oggm = read_variables(oggm_nc_file, IGM_SOURCE_VARIABLES + missing)
+    for thickness in missing:
+        # Write to a temporary file first, so no half-written file is reused
+        ds_igm = oggm_ds_to_igm_ds(ds_oggm, thickness)
+        if shm:
+            write_grids(ds_igm, os.path.dirname(files[thickness]))
+        else:
+            ds_igm.to_netcdf(files[thickness] + ".tmp")
+            os.replace(files[thickness] + ".tmp", files[thickness])
+
+    return files
 
+
+def oggm_ds_to_igm_ds(ds_oggm, thickness):
     # Rename the vars for IGM inversion
     rename_map = {
         "topo": "usurf",
@@ -47,20 +100,19 @@ def oggm_nc_to_igm_nc(oggm_nc_file, igm_nc_file, thickness = "consensus_ice_thic
     ds_igm["icemaskobs"] = ds_igm["icemask"]
     ds_igm["usurfobs"] = ds_igm["usurf"]
 
-    ds_igm["uvelsurfobs"] = ds_igm["uvelsurfobs"].where(ds_igm["icemask"] != 0, 0)
-    ds_igm["vvelsurfobs"] = ds_igm["vvelsurfobs"].where(ds_igm["icemask"] != 0, 0)
-    ds_igm["dhdt"] = ds_igm["dhdt"].where(ds_igm["icemask"] != 0, 0)
-    ds_igm["dhdt"] = ds_igm["dhdt"].fillna(0)
-
     # Convert ice mask datatype
     ds_igm = ds_igm.assign({"icemask": ds_igm["icemask"].astype(np.float32)})
     ds_igm = ds_igm.assign({"icemaskobs": ds_igm["icemaskobs"].astype(np.float32)})
 
+    # Velocities and dhdt are zero outside the mask, they are only processed on the mask cells (see masked_grid)
     # Smooth velocity fields
-    smoothed_uvel = scipy.signal.medfilt2d(ds_igm["uvelsurfobs"].values, kernel_size=3)
-    ds_igm = ds_igm.assign({"uvelsurfobs": (ds_igm["uvelsurfobs"].dims, smoothed_uvel)})
-    smoothed_vvel = scipy.signal.medfilt2d(ds_igm["vvelsurfobs"].values, kernel_size=3)
-    ds_igm = ds_igm.assign({"vvelsurfobs": (ds_igm["vvelsurfobs"].dims, smoothed_vvel)})
+    grid = masked_grid(ds_igm["icemask"].values)
+    for var in ["uvelsurfobs", "vvelsurfobs"]:
+        smoothed = masked_zero_medfilt(grid, ds_igm[var].values)
+        ds_igm = ds_igm.assign({var: (ds_igm[var].dims, smoothed)})
+
+    dhdt = np.nan_to_num(compress(grid, ds_igm["dhdt"].values), nan=0)
+    ds_igm["dhdt"] = ds_igm["dhdt"].copy(data=expand(grid, dhdt, 0))
 
     # Flip the data horizontally (not sure why this is necessary, but it is...)
     flipped_vars = {}
@@ -74,27 +126,31 @@ def oggm_nc_to_igm_nc(oggm_nc_file, igm_nc_file, thickness = "consensus_ice_thic
     coords = dict(ds_igm.coords)
     if "y" in coords:
         coords["y"] = coords["y"][::-1]
-    ds_flipped = xr.Dataset(flipped_vars, coords=coords, attrs=ds_igm.attrs)
+    return xr.Dataset(flipped_vars, coords=coords, attrs=ds_igm.attrs)
 
-    # Store input file for IGM inversion
-    if os.path.exists(igm_nc_file):
-        os.remove(igm_nc_file)
-    ds_flipped.to_netcdf(igm_nc_file)
 
-    # Close all nc-files
-    ds_oggm.close()
-    ds_igm.close()
-    ds_flipped.close()
+def file_hash(path, chunk_size=2**20):
+    sha = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
 
+@contextlib.contextmanager
+def file_lock(path):
+    # Exclusive lock between processes, the lock file is kept
+    with open(path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-def copy_variable_between_netcdfs(source_file, target_file, source_variable_name, target_variable_name):
-    ds_source = xr.open_dataset(source_file)
-    ds_target = xr.open_dataset(target_file, mode="r+")
-    var_data = ds_source[source_variable_name]
-    ds_updated = ds_target.assign({target_variable_name: var_data})
-    ds_updated.to_netcdf(target_file, mode="a")
-    ds_source.close()
-    ds_target.close()
+
+def gdir_path(base_dir, rgi_id):
+    # Folder structure of OGGM glacier directories: base_dir/RGI60-XX/RGI60-XX.XX/RGI_ID
+    return base_dir + "/" + rgi_id[:8] + "/" + rgi_id[:11] + "/" + rgi_id
 
 
 def delete_folder(path):
@@ -104,3 +160,16 @@ def delete_folder(path):
             os.remove(full_path)
         elif os.path.isdir(full_path):
             shutil.rmtree(full_path)
+
+
+def glacier_paths(rgi_id):
+    # Result files of the pipeline stages for one glacier (relative to the repository root)
+    return {
+        "gridded_data": "initial-geometries/res/" + rgi_id + "/gridded_data.nc",
+        "glacier_grid": "initial-geometries/res/" + rgi_id + "/glacier_grid.json",
+        "outlines": "initial-geometries/res/" + rgi_id + "/outlines.tar.gz",
+        "climate": "climate-background/res/" + rgi_id + "/simulation_climate.nc",
+        "climate_ensemble": "climate-background/res/" + rgi_id + "/simulation_climate_ensemble.nc",
+        "calibs": "mass-balance-calibrations/res/" + rgi_id,
+        "simulation_res": "forward-runs/simulation_res/" + rgi_id,
+    }
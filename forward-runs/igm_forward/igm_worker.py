@@ -0,0 +1,82 @@
+# Long-lived IGM process, started with igm_worker.sh SOCKET_PATH inside the IGM environment
+# TensorFlow and the IGM modules are imported once and shared by all runs of this worker
+# Requests (dicts) are received over a unix socket:
+#   {"params": dict, "cwd": str} -> {"returncode": int, "stdout": str, "stderr": str, "output": str}
+#   {"stop": True} -> the worker exits (also when the client disconnects)
+
+import json
+import os
+import sys
+import tempfile
+import traceback
+from multiprocessing.connection import Listener
+
+from igm.igm_run import main as igm_main
+
+# Files IGM leaves in the CWD (as in igm_run.sh)
+TEMP_FILES = ["params_saved.json", "costs.dat", "optimize.nc", "rms_std.dat", "clean.sh"]
+
+
+def main(socket_path):
+    with Listener(socket_path, family="AF_UNIX") as listener:
+        with listener.accept() as connection:
+            while True:
+                try:
+                    request = connection.recv()
+                except EOFError:
+                    break  # client is gone
+                if request.get("stop"):
+                    break
+                connection.send(run(request["params"], request["cwd"]))
+
+
+def run(params, cwd):
+    params_file = os.path.join(cwd, "params_run.json")
+    with open(params_file, "w") as file:
+        json.dump(params, file, indent=4)
+
+    start_dir = os.getcwd()
+    os.chdir(cwd)
+    sys.argv = ["igm_run", "--param_file", params_file]
+    try:
+        returncode, stdout, stderr = run_captured(igm_main)
+    finally:
+        for file in TEMP_FILES:
+            if os.path.exists(file):
+                os.remove(file)
+        os.chdir(start_dir)
+
+    return {"returncode": returncode, "stdout": stdout, "stderr": stderr, "output": params.get("wts_output_file")}
+
+
+def run_captured(func):
+    # Redirect the file descriptors, so the output of TensorFlow (C++) is captured as well
+    with tempfile.TemporaryFile(mode="w+") as out, tempfile.TemporaryFile(mode="w+") as err:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_stdout, saved_stderr = os.dup(1), os.dup(2)
+        os.dup2(out.fileno(), 1)
+        os.dup2(err.fileno(), 2)
+        try:
+            func()
+            returncode = 0
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            returncode = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved_stdout, 1)
+            os.dup2(saved_stderr, 2)
+            os.close(saved_stdout)
+            os.close(saved_stderr)
+
+        out.seek(0)
+        err.seek(0)
+        return returncode, out.read(), err.read()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
@@ -0,0 +1,5 @@
+#!/bin/bash
+
+#export TF_DEVICE_MIN_SYS_MEMORY_IN_MB=300
+source activate igm
+python "$(dirname "$0")/igm_worker.py" $1
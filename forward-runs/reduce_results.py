@@ -0,0 +1,43 @@
+# Ensemble statistics (common/ensemble_stats.py) from the run files of the done runs in the manifest, e.g. results from before the statistics were collected
+# Reads one run at a time and writes simulation_res/RGI_ID/ensemble_stats.nc (for climate members: member_K/ensemble_stats.nc)
+
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from common.utils import glacier_paths
+from common.manifest import load_manifest
+from common.ensemble_stats import SUMMARY_NAME, reduce_runs
+from run_projections import end_year, start_year
+from workflow import get_rgi_ids
+
+
+def main(rgi_ids, climate_member=None):
+    for rgi_id in rgi_ids:
+        out_folder = glacier_paths(rgi_id)["simulation_res"]
+        if climate_member is not None:
+            out_folder += "/member_" + str(climate_member)
+        if not os.path.isdir(out_folder):
+            print("No runs for " + rgi_id)
+            continue
+
+        reduce_runs(out_folder, start_year, end_year, load_manifest(out_folder + "/manifest.json"))
+        if os.path.exists(out_folder + "/" + SUMMARY_NAME):
+            print("Written " + out_folder + "/" + SUMMARY_NAME)
+        else:
+            print("No done runs for " + rgi_id)
+
+
+if __name__ == "__main__":
+    if os.path.basename(os.getcwd()) != "glacier-projections":
+        print("Error: The parent directory must be 'glacier-projections'. Exiting.")
+        sys.exit(1)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rgi_ids", nargs="*", help="RGI IDs or text files with one RGI ID per line")
+    parser.add_argument("--member", type=int, default=None, help="Climate member (results in member_K)")
+    args = parser.parse_args()
+
+    main(get_rgi_ids(args.rgi_ids), args.member)
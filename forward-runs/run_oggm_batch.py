@@ -0,0 +1,115 @@
+# OGGM forward runs (with and without sliding) for many glaciers at once
+# The glacier directories are built from the local results of the previous stages, nothing is downloaded
+# All variants (glacier x thickness x calibration x sliding) are distributed with OGGM's multiprocessing pool
+# The runs are recorded in the same manifest and ensemble statistics as in run_projections.py, up-to-date runs are skipped
+# IGM runs are not part of this batch, use run_projections.py for them
+
+import argparse
+import os
+import shutil
+import sys
+import oggm.cfg as cfg
+from oggm import workflow
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from common.utils import file_hash, glacier_paths
+from common.smb import smb_tables
+from run_projections import (
+    RESULT_STORE,
+    SMB_CACHE,
+    USE_SMB_TABLE,
+    thicknesses,
+    cached_flowlines,
+    copy_oggm_gdir,
+    ensemble_summary,
+    glacier_calibs,
+    has_var,
+    init_oggm_gdir,
+    oggm_forward,
+    pending_runs,
+    recorded_run,
+)
+from workflow import get_rgi_ids
+
+TEMP_WD = "forward-runs/temp_batch"  # TEMP_WD/RGI_ID, the variants are in TEMP_WD/RGI_ID/runs
+
+
+def main(rgi_ids, mp_processes=None):
+    variants = []
+    for rgi_id in rgi_ids:
+        variants.extend(glacier_variants(rgi_id))
+
+    # init_oggm_gdir resets the config, so the multiprocessing settings are applied afterwards
+    cfg.PARAMS["continue_on_error"] = False
+    cfg.PARAMS["use_multiprocessing"] = mp_processes != 1
+    if mp_processes is not None:
+        cfg.PARAMS["mp_processes"] = mp_processes
+
+    workflow.execute_entity_task(oggm_variant, variants)
+
+    for rgi_id in rgi_ids:
+        paths = glacier_paths(rgi_id)
+        ensemble_summary(rgi_id, paths["simulation_res"], paths["simulation_res"] + "/manifest.json")
+        if os.path.exists(TEMP_WD + "/" + rgi_id):
+            shutil.rmtree(TEMP_WD + "/" + rgi_id)
+
+
+def glacier_variants(rgi_id):
+    # One gdir per variant: (gdir, task kwargs) as accepted by execute_entity_task
+    paths = glacier_paths(rgi_id)
+    temp_wd = TEMP_WD + "/" + rgi_id
+    out_folder = paths["simulation_res"]
+
+    available = [thickness for thickness in thicknesses if has_var(paths["gridded_data"], thickness)]
+    run_calibs = glacier_calibs(paths)
+    runs = pending_runs(rgi_id, out_folder + "/manifest.json", file_hash(paths["climate"]), available, run_calibs, ["oggm", "oggmslide"])
+    if not runs:
+        return []
+
+    base_gdir = init_oggm_gdir(rgi_id, temp_wd, paths["climate"])
+    flowlines = {}
+    for thickness in sorted(set(run[1] for run in runs)):
+        flowlines[thickness] = cached_flowlines(base_gdir, thickness, temp_wd)
+    tables = {}
+    if USE_SMB_TABLE:
+        calib_files = {calib: paths["calibs"] + "/" + calib + ".json" for calib in run_calibs}
+        tables = smb_tables(paths["climate"], calib_files, paths["gridded_data"], SMB_CACHE + "/" + rgi_id + "/smb")
+
+    variants = []
+    for _, thickness, calib, model, run_hash in runs:
+        run_dir = temp_wd + "/runs/" + thickness + "_" + calib + "_" + model
+        gdir = copy_oggm_gdir(rgi_id, base_gdir.dir, run_dir)
+        kwargs = {
+            "thickness": thickness,
+            "mb_calib": calib,
+            "out_folder": out_folder,
+            "flowlines_dir": flowlines[thickness],
+            "store_file": RESULT_STORE + ".nc",
+            "sliding": model == "oggmslide",
+            "smb_table": tables.get(calib),
+            "run_hash": run_hash,
+        }
+        variants.append((gdir, kwargs))
+    return variants
+
+
+def oggm_variant(gdir, thickness, mb_calib, out_folder, flowlines_dir, store_file, sliding, smb_table, run_hash):
+    # Entity task signature (gdir first) for oggm_forward, which sets fs in the config of this worker process
+    # Recorded in the manifest and the ensemble statistics like the runs of run_projections.py
+    model = "oggmslide" if sliding else "oggm"
+    with recorded_run(out_folder, gdir.rgi_id, thickness, mb_calib, model, run_hash):
+        oggm_forward(thickness, mb_calib, gdir, out_folder, flowlines_dir, store_file, sliding=sliding, smb_table=smb_table)
+
+
+if __name__ == "__main__":
+    if os.path.basename(os.getcwd()) != "glacier-projections":
+        print("Error: The parent directory must be 'glacier-projections'. Exiting.")
+        sys.exit(1)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rgi_ids", nargs="*", help="RGI IDs or text files with one RGI ID per line")
+    parser.add_argument("--mp-processes", type=int, default=None, help="Number of OGGM processes (default: all cores)")
+    args = parser.parse_args()
+
+    main(get_rgi_ids(args.rgi_ids), args.mp_processes)
@@ -1,28 +1,41 @@
 # Create OGGM projections using the initial geometries, mass balance calibration and synthetic climate data
 
+import contextlib
+import csv
+import hashlib
 import os
 import shutil
-import subprocess
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 import oggm.cfg as cfg
-from oggm import workflow, DEFAULT_BASE_URL, tasks
+import oggm.utils as utils
+from oggm import tasks
+from oggm.core.flowline import flowline_model_run
+from oggm.core.massbalance import MassBalanceModel, MultipleFlowlineMassBalance
 
 # toDo: Add IGM model import?
 
 # Import utils
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from common.utils import *
-
-if len(sys.argv) <= 1:
-    RGI_ID = "RGI60-11.00897"
-else:
-    RGI_ID = sys.argv[1]
+from common.igm_client import IGMWorker, run_igm_subprocess
+from common.result_store import append_run
+from common.manifest import inputs_hash, is_up_to_date, load_manifest, record_run, run_key
+from common.instrument import annotate, instrument
+from common.catalog import has_variable
+from common.smb import ELEVATION_STEP, smb_tables, use_smb_table
+from common.datasets import open_dataset, read_variables, release
+from common.shm_grids import SHM_DIR, is_descriptor, use_shm_input
+from common.ensemble_stats import STATE_NAME, add_run, summarize
 
 start_year = 2000
 end_year = 2500
 
 thicknesses = [
     "igm_inv_thickness",
+    "igm_millan_thickness",  # only if enabled in get_initial_data.IGM_INVERSION_SEEDS
+    "igm_cook23_thickness",  # only if enabled in get_initial_data.IGM_INVERSION_SEEDS
     "millan_ice_thickness",
     "consensus_ice_thickness",
     "cook23_ice_thickness",
@@ -35,63 +48,269 @@ calibs = [
     "meltf_only",
 ]
 
-# Shared data across the flow models
-CLIMATE_FILE = "climate-background/res/" + RGI_ID + "/simulation_climate.nc"
-INITIAL_GEOMETRIES_FILE = "initial-geometries/res/" + RGI_ID + "/gridded_data.nc"
-CALIBS_PATH = "mass-balance-calibrations/res/" + RGI_ID
-OUT_FOLDER_NAME = "simulation_res/" + RGI_ID
+# Calibration sweep (mass-balance-calibrations/sweep_calibrations.py): the successful points of the sweep table are run as additional calibrations
+USE_SWEEP_CALIBS = False
+SWEEP_TABLE = "sweep.csv"
+
+models = [
+    "oggm",
+    "oggmslide",
+    "igm",
+]
+
+# Early termination of OGGM runs (see stop_criterion), the output is padded to the full period
+EARLY_STOP = True
+EXTINCTION_YEARS = 5  # stop after this many years without ice
+EQUILIBRIUM_YEARS = 100  # stop if all volumes of this many years are within EQUILIBRIUM_TOLERANCE (max - min, relative to max)
+EQUILIBRIUM_TOLERANCE = 0.001
+
+# OGGM runs take the SMB from precomputed tables (common/smb.py) instead of OGGM's MonthlyTIModel
+USE_SMB_TABLE = False
+SMB_CACHE = "forward-runs/cache"  # SMB_CACHE/RGI_ID/smb
 
 # IGM
-TEMP_IGM_NC = "forward-runs/igm_forward_temp.nc"
+IGM_TIME_SAVE = 1.0  # output interval (years) of the IGM runs, years in between are NaN in the result store
+IGM_INPUT_CACHE = "forward-runs/cache"  # IGM_INPUT_CACHE/RGI_ID/igm_input, e.g. a folder in /dev/shm to keep them in memory
+USE_IGM_SHM = False  # hand the input grids to IGM as .npy files in SHM_DIR/RGI_ID (common/shm_grids.py), removed after the runs
 IGM_PARAMS_FORWARD = "forward-runs/igm_forward/params_ti.json"
 IGM_RUN_SH = "forward-runs/igm_forward/igm_run.sh"
+IGM_WORKER_SH = "forward-runs/igm_forward/igm_worker.sh"
+USE_IGM_WORKER = True  # one long-lived IGM process per worker instead of igm_run.sh per run
+
+_igm_worker = None  # IGM worker of this process, started with the first IGM run
+
+# All runs are also collected in one file (for climate members: RESULT_STORE_member_K.nc)
+RESULT_STORE = "forward-runs/simulation_res/ensemble_results"
 
 # OGGM
-TEMP_WD = "forward-runs/temp"
-OUTLINES_FILE = "initial-geometries/res/" + RGI_ID + "/outlines.tar.gz"
-GRID_FILE = "initial-geometries/res/" + RGI_ID + "/glacier_grid.json"
+TEMP_WD = "forward-runs/temp"  # TEMP_WD/RGI_ID, the runs are in TEMP_WD/RGI_ID/runs
+FLOWLINE_CACHE = "forward-runs/cache"  # FLOWLINE_CACHE/RGI_ID/flowlines/THICKNESS_HASH
 
 
-def main():
-    gdir = init_oggm_gdir()
+def main(rgi_id, n_workers=1, climate_member=None):
+    paths = glacier_paths(rgi_id)
+    temp_wd = TEMP_WD + "/" + rgi_id
 
-    for thickness in thicknesses:
-        if not has_var(INITIAL_GEOMETRIES_FILE, thickness):
-            continue  # skip
-        for calib in calibs:
-            print("Processing " + thickness + " | " + calib)
-            oggm_forward(thickness, calib, gdir)
-            oggm_forward(thickness, calib, gdir, sliding=True)
-            igm_forward(thickness, calib)
+    # Climate member from the ensemble file (None: the single realisation)
+    if climate_member is None:
+        out_folder = paths["simulation_res"]
+        store_file = RESULT_STORE + ".nc"
+        climate_hash = file_hash(paths["climate"])
+    else:
+        out_folder = paths["simulation_res"] + "/member_" + str(climate_member)
+        store_file = RESULT_STORE + "_member_" + str(climate_member) + ".nc"
+        climate_hash = file_hash(paths["climate_ensemble"]) + "_" + str(climate_member)
+
+    # Runs that finished with the same inputs are skipped (see common/manifest.py)
+    manifest_file = out_folder + "/manifest.json"
+    run_calibs = glacier_calibs(paths)
+    available = [thickness for thickness in thicknesses if has_var(paths["gridded_data"], thickness)]
+    runs = pending_runs(rgi_id, manifest_file, climate_hash, available, run_calibs, models)
+
+    if not runs:
+        ensemble_summary(rgi_id, out_folder, manifest_file)
+        return
+
+    if climate_member is None:
+        climate_file = paths["climate"]
+    else:
+        os.makedirs(temp_wd, exist_ok=True)
+        climate_file = temp_wd + "/simulation_climate_member.nc"
+        extract_climate_member(paths["climate_ensemble"], climate_member, climate_file)
+
+    gdir = init_oggm_gdir(rgi_id, temp_wd, climate_file)
+    setup = {
+        "gdir_dir": gdir.dir,
+        "runs_wd": temp_wd + "/runs",
+        "climate_file": os.path.abspath(climate_file),
+        "out_folder": out_folder,
+        "store_file": store_file,
+        "flowlines": {},
+        "smb_tables": {},
+    }
+
+    # Shared inputs, the same for all calibrations (only for the thicknesses that are run)
+    run_thicknesses = [thickness for thickness in available if any(run[1] == thickness for run in runs)]
+    for thickness in run_thicknesses:
+        with instrument("flowlines", rgi_id, thickness=thickness):
+            setup["flowlines"][thickness] = cached_flowlines(gdir, thickness, temp_wd)
+    if USE_IGM_SHM:
+        igm_input_dir = SHM_DIR + "/" + rgi_id + "/igm_input"
+    else:
+        igm_input_dir = os.path.abspath(IGM_INPUT_CACHE + "/" + rgi_id + "/igm_input")
+    with instrument("igm_inputs", rgi_id):
+        setup["igm_inputs"] = igm_inputs(paths["gridded_data"], run_thicknesses, igm_input_dir, shm=USE_IGM_SHM)
+    if USE_SMB_TABLE:
+        calib_files = {calib: paths["calibs"] + "/" + calib + ".json" for calib in run_calibs}
+        with instrument("smb_tables", rgi_id):
+            setup["smb_tables"] = smb_tables(climate_file, calib_files, paths["gridded_data"], SMB_CACHE + "/" + rgi_id + "/smb")
+
+    try:
+        run_ensemble(runs, setup, n_workers)
+    finally:
+        close_igm_worker()
+        if USE_IGM_SHM:
+            shutil.rmtree(igm_input_dir)  # free the memory
+
+    # Ensemble statistics of all finished runs (common/ensemble_stats.py)
+    ensemble_summary(rgi_id, out_folder, manifest_file)
 
     # Clean the gdir
-    shutil.rmtree(TEMP_WD)
+    shutil.rmtree(temp_wd)
+
+
+def pending_runs(rgi_id, manifest_file, climate_hash, run_thicknesses, run_calibs, run_models):
+    # Runs (rgi_id, thickness, calib, model, inputs hash) which are not up to date in the manifest
+    paths = glacier_paths(rgi_id)
+    manifest = load_manifest(manifest_file)
+    file_hashes = {
+        "climate": climate_hash,
+        "gridded_data": file_hash(paths["gridded_data"]),
+        "igm_params": file_hash(IGM_PARAMS_FORWARD),
+    }
+    calib_hashes = {calib: file_hash(paths["calibs"] + "/" + calib + ".json") for calib in run_calibs}
+
+    runs = []
+    for thickness in run_thicknesses:
+        for calib in run_calibs:
+            for model in run_models:
+                run_hash = run_inputs_hash(thickness, calib, model, file_hashes, calib_hashes[calib])
+                if is_up_to_date(manifest, run_key(thickness, calib, model), run_hash):
+                    print("Up to date " + rgi_id + " | " + thickness + " | " + calib + " | " + model)
+                    continue
+                runs.append((rgi_id, thickness, calib, model, run_hash))
+    return runs
+
+
+def glacier_calibs(paths):
+    if not USE_SWEEP_CALIBS or not os.path.exists(paths["calibs"] + "/" + SWEEP_TABLE):
+        return calibs
+    with open(paths["calibs"] + "/" + SWEEP_TABLE, "r", newline="") as file:
+        return calibs + [row["name"] for row in csv.DictReader(file) if row["success"] == "1"]
+
+
+def ensemble_summary(rgi_id, out_folder, manifest_file):
+    with instrument("ensemble_summary", rgi_id):
+        summarize(out_folder, start_year, end_year, load_manifest(manifest_file))
+
+
+def run_ensemble(runs, setup, n_workers):
+    # Every run works on its own copy of the gdir and its own IGM files, so the runs are independent
+    if n_workers <= 1:
+        for run in runs:
+            run_single(run, setup)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker) as executor:
+        futures = [executor.submit(run_single, run, setup) for run in runs]
+        # Collect in submission order so errors show up as in a serial run
+        for future in futures:
+            future.result()
+
+
+def init_worker():
+    cfg.initialize(logging_level="WARNING")
+
+
+def run_single(run, setup):
+    rgi_id, thickness, calib, model, run_hash = run
+    print("Processing " + rgi_id + " | " + thickness + " | " + calib + " | " + model)
+
+    run_dir = setup["runs_wd"] + "/" + thickness + "_" + calib + "_" + model
+    if os.path.exists(run_dir):
+        shutil.rmtree(run_dir)
+    os.makedirs(run_dir)
+
+    with recorded_run(setup["out_folder"], rgi_id, thickness, calib, model, run_hash):
+        with instrument("run", rgi_id, thickness=thickness, calib=calib, model=model):
+            if model == "igm":
+                igm_forward(rgi_id, thickness, calib, run_dir, setup["igm_inputs"][thickness], setup["climate_file"], setup["out_folder"], setup["store_file"], smb_table=setup["smb_tables"].get(calib))
+            else:
+                gdir = copy_oggm_gdir(rgi_id, setup["gdir_dir"], run_dir)
+                oggm_forward(thickness, calib, gdir, setup["out_folder"], setup["flowlines"][thickness], setup["store_file"], sliding=(model == "oggmslide"), smb_table=setup["smb_tables"].get(calib))
+
+    shutil.rmtree(run_dir)
+
+
+@contextlib.contextmanager
+def recorded_run(out_folder, rgi_id, thickness, calib, model, run_hash):
+    # The run is recorded in the manifest (failed or done) and a finished run is added to the ensemble statistics
+    key = run_key(thickness, calib, model)
+    output = run_output(out_folder, thickness, calib, model)
+    try:
+        yield
+    except Exception:
+        record_run(out_folder + "/manifest.json", key, run_hash, output, "failed")
+        raise
+    record_run(out_folder + "/manifest.json", key, run_hash, output, "done")
+    with instrument("stats", rgi_id):
+        add_run(out_folder + "/" + STATE_NAME, thickness, calib, model, run_hash, output, start_year, end_year)
+
+
+def run_inputs_hash(thickness, calib, model, file_hashes, calib_hash):
+    # Everything a run depends on, a change of any of it makes the run stale
+    hashes = {"climate": file_hashes["climate"], "gridded_data": file_hashes["gridded_data"], "calib": calib_hash}
+    if model == "igm":
+        hashes["igm_params"] = file_hashes["igm_params"]
+    settings = {"thickness": thickness, "calib": calib, "model": model, "start_year": start_year, "end_year": end_year}
+    if USE_SMB_TABLE:
+        settings["smb_table"] = ELEVATION_STEP
+    if model == "igm":
+        settings["time_save"] = IGM_TIME_SAVE
+    elif EARLY_STOP:
+        settings["early_stop"] = ["window", EXTINCTION_YEARS, EQUILIBRIUM_YEARS, EQUILIBRIUM_TOLERANCE]
+    return inputs_hash(hashes, settings)
+
+
+def run_output(out_folder, thickness, calib, model):
+    # Output file of oggm_forward / igm_forward
+    return out_folder + "/" + thickness + "_" + model + "_" + calib + ".nc"
+
+
+def copy_oggm_gdir(rgi_id, gdir_dir, run_dir):
+    base_dir = run_dir + "/per_glacier"
+    shutil.copytree(gdir_dir, gdir_path(base_dir, rgi_id))
+    return utils.GlacierDirectory(rgi_id, base_dir=base_dir)
 
 
-def init_oggm_gdir():
-    cfg.initialize()
+def extract_climate_member(ensemble_file, member, out):
+    # Only the chunks of the selected member are read
+    release(out)
+    open_dataset(ensemble_file, use_cftime=True).isel(member=member).drop_vars("member").to_netcdf(out)
 
-    cfg.PATHS["working_dir"] = TEMP_WD
 
-    # Get a new gdir
-    gdir = workflow.init_glacier_directories(RGI_ID, prepro_base_url=DEFAULT_BASE_URL, from_prepro_level=4)[0]
+def init_oggm_gdir(rgi_id, temp_wd, climate_file):
+    paths = glacier_paths(rgi_id)
+
+    cfg.initialize()
+
+    cfg.PATHS["working_dir"] = temp_wd
 
-    # Delete everyting in the gdir (I don't know how to initialize an empty gdir...)
-    print(gdir.dir)
-    shutil.rmtree(gdir.dir)
-    os.makedirs(gdir.dir)
+    # The gdir is built from the previously generated files only, no preprocessed gdir is needed
+    base_dir = temp_wd + "/per_glacier"
+    gdir_dir = gdir_path(base_dir, rgi_id)
+    if os.path.exists(gdir_dir):
+        shutil.rmtree(gdir_dir)
+    os.makedirs(gdir_dir)
 
     # Copy the previously generated files for the simulation
-    shutil.copy(CLIMATE_FILE, gdir.dir + "/climate_historical.nc")  # we need to name it "historical" for sanity checks
-    shutil.copy(INITIAL_GEOMETRIES_FILE, gdir.dir + "/gridded_data.nc")
-    shutil.copy(GRID_FILE, gdir.dir + "/glacier_grid.json")
-    shutil.copy(OUTLINES_FILE, gdir.dir + "/outlines.tar.gz")
-    return gdir
+    shutil.copy(climate_file, gdir_dir + "/climate_historical.nc")  # we need to name it "historical" for sanity checks
+    shutil.copy(paths["gridded_data"], gdir_dir + "/gridded_data.nc")
+    shutil.copy(paths["glacier_grid"], gdir_dir + "/glacier_grid.json")
+    shutil.copy(paths["outlines"], gdir_dir + "/outlines.tar.gz")
 
+    # The glacier entity is read from outlines.tar.gz
+    return utils.GlacierDirectory(rgi_id, base_dir=base_dir)
 
-def oggm_forward(thickness, mb_calib, gdir, sliding=False):
-    shutil.copy(CALIBS_PATH + "/" + mb_calib + ".json", gdir.dir + "/mb_calib.json")
-    prepare_simulation(gdir, thk_var=thickness)
+
+def oggm_forward(thickness, mb_calib, gdir, out_folder, flowlines_dir, store_file=None, sliding=False, smb_table=None):
+    paths = glacier_paths(gdir.rgi_id)
+
+    shutil.copy(paths["calibs"] + "/" + mb_calib + ".json", gdir.dir + "/mb_calib.json")
+
+    # Flowlines from prepare_simulation (see cached_flowlines)
+    for file in os.listdir(flowlines_dir):
+        shutil.copy(flowlines_dir + "/" + file, gdir.dir + "/" + file)
 
     if sliding:
         cfg.PARAMS["fs"] = 5.7e-20
@@ -103,22 +322,113 @@ def oggm_forward(thickness, mb_calib, gdir, sliding=False):
         cfg.PARAMS["inversion_fs"] = 0
         id = "_oggm_"
 
-    tasks.run_from_climate_data(
-        gdir,
-        ys=start_year,
-        ye=end_year,
-        climate_filename="climate_historical",
-        climate_input_filesuffix="",
-        output_filesuffix="_" + thickness + "_" + mb_calib + "_" + id,
-        store_model_geometry=False,
-    )
-
-    if not os.path.exists("forward-runs/" + OUT_FOLDER_NAME):
-        os.makedirs("forward-runs/" + OUT_FOLDER_NAME)
+    with instrument("oggm_dynamics", gdir.rgi_id):
+        if smb_table is None:
+            tasks.run_from_climate_data(
+                gdir,
+                ys=start_year,
+                ye=end_year,
+                climate_filename="climate_historical",
+                climate_input_filesuffix="",
+                output_filesuffix="_" + thickness + "_" + mb_calib + "_" + id,
+                store_model_geometry=False,
+                stop_criterion=stop_criterion if EARLY_STOP else None,
+            )
+        else:
+            flowline_model_run(
+                gdir,
+                mb_model=MultipleFlowlineMassBalance(gdir, mb_model_class=TableMassBalance, table_file=smb_table),
+                ys=start_year,
+                ye=end_year,
+                output_filesuffix="_" + thickness + "_" + mb_calib + "_" + id,
+                store_model_geometry=False,
+                stop_criterion=stop_criterion if EARLY_STOP else None,
+            )
+
+    # exist_ok: parallel runs may create it at the same time
+    os.makedirs(out_folder, exist_ok=True)
 
     file_name = "model_diagnostics" + "_" + thickness + "_" + mb_calib + "_" + id + ".nc"
-    out_name = "forward-runs/" + OUT_FOLDER_NAME + "/" + thickness + id + mb_calib + ".nc"
-    shutil.copy(gdir.dir + "/" + file_name, out_name)
+    out_name = run_output(out_folder, thickness, mb_calib, id.strip("_"))
+    pad_diagnostics(gdir.dir + "/" + file_name, out_name)
+
+    if store_file is not None:
+        with instrument("store", gdir.rgi_id):
+            append_run(store_file, out_name, gdir.rgi_id, thickness, id.strip("_"), mb_calib, start_year, end_year)
+
+
+class TableMassBalance(MassBalanceModel):
+    # Annual SMB interpolated from a table of common/smb.py (elevation x year, kg m-2 yr-1)
+    def __init__(self, gdir, table_file=None, **kwargs):
+        super().__init__()
+        ds = read_variables(table_file, ["smb"])
+        self.elevations = ds["elevation"].values
+        self.first_year = int(ds["year"].values[0])
+        self.smb = ds["smb"].values
+        self.valid_bounds = [self.elevations[0], self.elevations[-1]]
+        self.hemisphere = gdir.hemisphere
+
+    def get_annual_mb(self, heights, year=None, fl_id=None, fls=None):
+        smb = np.interp(heights, self.elevations, self.smb[:, int(year) - self.first_year])
+        return smb / cfg.SEC_IN_YEAR / self.rho  # m ice s-1
+
+    def get_monthly_mb(self, heights, year=None, fl_id=None, fls=None):
+        # Rate of the year (the table has no monthly resolution)
+        return self.get_annual_mb(heights, year=year, fl_id=fl_id, fls=fls)
+
+
+def stop_criterion(model, state):
+    # OGGM stop criterion: extinction or equilibrium, evaluated once per year
+    # Equilibrium: all volumes of the window [year - EQUILIBRIUM_YEARS, year] are within EQUILIBRIUM_TOLERANCE (relative to the maximum)
+    if state is None:
+        state = {"volumes": deque(maxlen=EQUILIBRIUM_YEARS + 1), "zero_years": 0, "year": None}
+    year = int(round(model.yr))
+    if year == state["year"]:
+        return False, state
+    state["year"] = year
+
+    volume = model.volume_m3
+    state["volumes"].append(volume)
+    state["zero_years"] = state["zero_years"] + 1 if volume == 0 else 0
+    if state["zero_years"] >= EXTINCTION_YEARS:
+        return True, state
+
+    volumes = state["volumes"]
+    if len(volumes) == volumes.maxlen and max(volumes) > 0 and (max(volumes) - min(volumes)) / max(volumes) < EQUILIBRIUM_TOLERANCE:
+        return True, state
+
+    return False, state
+
+
+def pad_diagnostics(diagnostics_file, out):
+    # After an early stop, the years up to end_year are missing or NaN, the last values are kept until end_year
+    # so every output covers the full period
+    years = np.arange(start_year, end_year + 1)
+    with xr.open_dataset(diagnostics_file) as ds:
+        ds = ds.load()
+
+    if ds.sizes["time"] != len(years):
+        # Annual output: the years are rebuilt, the months are the same in every time step
+        months = {coord: ds[coord].values[0] for coord in ["calendar_month", "hydro_month"] if coord in ds.coords}
+        ds = ds.reindex(time=years.astype(ds["time"].dtype))
+        for coord in ["calendar_year", "hydro_year"]:
+            if coord in ds.coords:
+                ds = ds.assign_coords({coord: ("time", years)})
+        for coord, month in months.items():
+            ds = ds.assign_coords({coord: ("time", np.full(len(years), month))})
+
+    for var in ds.data_vars:
+        if "time" in ds[var].dims and np.issubdtype(ds[var].dtype, np.floating):
+            values = ds[var].transpose("time", ...).values
+            ds[var] = ds[var].transpose("time", ...).copy(data=forward_fill(values))
+    ds.to_netcdf(out)
+
+
+def forward_fill(values):
+    # NaNs along the first axis are replaced by the last valid value before them
+    index = np.where(np.isnan(values), 0, np.arange(len(values)).reshape((-1,) + (1,) * (values.ndim - 1)))
+    index = np.maximum.accumulate(index, axis=0)
+    return np.take_along_axis(values, index, axis=0)
 
 
 def prepare_simulation(gdir, thk_var):
@@ -136,26 +446,77 @@ def prepare_simulation(gdir, thk_var):
     # -> Creates the model_flowlines.pkl
 
 
-def igm_forward(thickness, calib, detailed=False):
-    print("Processing IGM")
-    oggm_nc_to_igm_nc(INITIAL_GEOMETRIES_FILE, TEMP_IGM_NC, thickness)
-
+def cached_flowlines(gdir, thickness, temp_wd):
+    # The flowline preprocessing only depends on the gridded data and the thickness variable, not on the calibration
+    # It is done once per thickness, the resulting files are kept until the gridded data changes
+    inputs_hash = file_hash(gdir.dir + "/gridded_data.nc") + file_hash(gdir.dir + "/glacier_grid.json")
+    key = hashlib.sha256((inputs_hash + thickness).encode()).hexdigest()[:16]
+    cache_folder = FLOWLINE_CACHE + "/" + gdir.rgi_id + "/flowlines"
+    cache_dir = cache_folder + "/" + thickness + "_" + key
+    if os.path.exists(cache_dir):
+        return cache_dir
+
+    # Remove outdated flowlines of this thickness
+    if os.path.exists(cache_folder):
+        for name in os.listdir(cache_folder):
+            if name.startswith(thickness + "_"):
+                shutil.rmtree(cache_folder + "/" + name)
+
+    # Run the preprocessing in a copy of the gdir and keep all files created or changed by it
+    prepare_dir = temp_wd + "/prepare/" + thickness
+    prepare_gdir = copy_oggm_gdir(gdir.rgi_id, gdir.dir, prepare_dir)
+    before = folder_state(prepare_gdir.dir)
+    prepare_simulation(prepare_gdir, thk_var=thickness)
+    after = folder_state(prepare_gdir.dir)
+
+    os.makedirs(cache_dir + ".tmp")
+    for file, state in after.items():
+        if before.get(file) != state and file != "log.txt":
+            shutil.copy2(prepare_gdir.dir + "/" + file, cache_dir + ".tmp/" + file)
+    os.rename(cache_dir + ".tmp", cache_dir)
+
+    shutil.rmtree(prepare_dir)
+    return cache_dir
+
+
+def folder_state(path):
+    state = {}
+    for file in os.listdir(path):
+        if os.path.isfile(path + "/" + file):
+            stat = os.stat(path + "/" + file)
+            state[file] = (stat.st_size, stat.st_mtime_ns)
+    return state
+
+
+def igm_forward(rgi_id, thickness, calib, run_dir, igm_nc, climate_file, out_folder, store_file=None, detailed=False, smb_table=None):
+    paths = glacier_paths(rgi_id)
+
+    # IGM runs inside the run directory (it writes its own temp files to the CWD), so all paths are absolute
+    # igm_nc is the shared input file of this thickness (see igm_inputs), IGM only reads it
     params = load_json_with_comments(IGM_PARAMS_FORWARD)
-    params["lncd_input_file"] = TEMP_IGM_NC
+    params["lncd_input_file"] = igm_nc
+    if is_descriptor(igm_nc):
+        use_shm_input(params, igm_nc, run_dir)
     # params["iflo_emulator"] = inversion_dir + "/iceflow-model"
     params["iflo_emulator"] = ""
 
-    out_file_name = "forward-runs/" + OUT_FOLDER_NAME + "/" + thickness + "_igm_" + calib + ".nc"
-    params["wts_output_file"] = out_file_name
+    # exist_ok: parallel runs may create it at the same time
+    os.makedirs(out_folder, exist_ok=True)
+
+    out_file_name = run_output(out_folder, thickness, calib, "igm")
+    params["wts_output_file"] = os.path.abspath(out_file_name)
 
-    calib_file = CALIBS_PATH + "/" + calib + ".json"
+    calib_file = os.path.abspath(paths["calibs"] + "/" + calib + ".json")
     params["smb_mb_calib_file"] = calib_file
     params["clim_mb_calib_file"] = calib_file
-    params["clim_forward_climate_file"] = CLIMATE_FILE
+    params["clim_forward_climate_file"] = climate_file
+
+    if smb_table is not None:
+        use_smb_table(params, smb_table, run_dir)
 
     params["time_start"] = start_year
     params["time_end"] = end_year
-    params["time_save"] = 1.0
+    params["time_save"] = IGM_TIME_SAVE
 
     if detailed:
         params["modules_postproc"] = ["write_ts", "print_info", "write_ncdf"]
@@ -174,22 +535,49 @@ def igm_forward(thickness, calib, detailed=False):
             "meanprec",
             "meantemp",
         ]
-        params["wncd_output_file"] = "forward-runs/" + OUT_FOLDER_NAME + "/" + thickness + "_igm_" + "test_vars" + ".nc"
-
-    save_json_to_file(params, "forward-runs" + "/params_run.json")
+        params["wncd_output_file"] = os.path.abspath(out_folder + "/" + thickness + "_igm_" + "test_vars" + ".nc")
 
     # Run
-    result = subprocess.run([IGM_RUN_SH, "forward-runs" + "/params_run.json"])
-    print("Output:", result.stdout)
-    print("Error:", result.stderr)
-    print("Return Code:", result.returncode)
+    with instrument("igm_dynamics", rgi_id):
+        result = run_igm(params, run_dir)
+        annotate(returncode=result["returncode"])
+    print("Return Code:", result["returncode"])
+    if result["returncode"] != 0:
+        raise RuntimeError("IGM run failed for " + out_file_name + ":\n" + result["stdout"][-2000:] + result["stderr"][-2000:])
+
+    if store_file is not None:
+        with instrument("store", rgi_id):
+            append_run(store_file, out_file_name, rgi_id, thickness, "igm", calib, start_year, end_year)
+
+
+def run_igm(params, run_dir):
+    global _igm_worker
+    if not USE_IGM_WORKER:
+        return run_igm_subprocess(IGM_RUN_SH, params, run_dir)
+
+    if _igm_worker is None:
+        # Conda activation and TensorFlow import, once per process
+        with instrument("igm_worker_start"):
+            _igm_worker = IGMWorker(IGM_WORKER_SH)
+    return _igm_worker.run(params, run_dir)
+
 
-    os.remove(TEMP_IGM_NC)
+def close_igm_worker():
+    # Workers of the process pool do not need this, their IGM worker stops when the connection is closed
+    global _igm_worker
+    if _igm_worker is not None:
+        _igm_worker.close()
+        _igm_worker = None
 
 
 def has_var(path, varname):
-    with xr.open_dataset(path) as ds:
-        return varname in ds
+    # From the catalog of the res folder, the file is only opened if it is not indexed yet
+    return has_variable(path, varname)
 
 
-main()
+if __name__ == "__main__":
+    # Arguments: RGI_ID [N_WORKERS] [CLIMATE_MEMBER]
+    rgi_id = "RGI60-11.00897" if len(sys.argv) <= 1 else sys.argv[1]
+    n_workers = 1 if len(sys.argv) <= 2 else int(sys.argv[2])
+    climate_member = None if len(sys.argv) <= 3 else int(sys.argv[3])
+    main(rgi_id, n_workers, climate_member)
@@ -8,45 +8,62 @@ import os
 import shutil
 import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import oggm.cfg as cfg
 import oggm.utils as utils
 import oggm.workflow as workflow
 import oggm.tasks as tasks
-import xarray as xr
 
 # Import utils
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
 from common.utils import *
-
-if len(sys.argv) <= 1:
-    RGI_ID = "RGI60-11.01450"
-else:
-    RGI_ID = sys.argv[1]
+from common.gdir_cache import init_cached_gdir
+from common.masked_grid import compress, expand, masked_grid, thickness_stats
+from common.catalog import update_catalog
+from common.datasets import open_dataset, read_variables, release
+from common.shm_grids import SHM_DIR, is_descriptor, use_shm_input
 
 NO_SPINUP_URL = "https://cluster.klima.uni-bremen.de/~oggm/gdirs/oggm_v1.6/L3-L5_files/2023.3/elev_bands/W5E5"
 
+# Temporary directories are created per glacier (TEMP_WD/RGI_ID), so several glaciers can be processed at once
 TEMP_WD = "initial-geometries/temp"
 TEMP_WD_OGGM_INVERSION = "initial-geometries/temp_inver"
+TEMP_WD_IGM_INVERSION = "initial-geometries/temp_igm"
 
 IGM_INVERSION_PARAM_FILE = "initial-geometries/igm_inv/igm_inv_params.json"
 IGM_INVERSION_BASH_SCRIPT = "initial-geometries/igm_inv/igm_run.sh"
-TEMP_IGM_NC = "initial-geometries/igm_inv/temp_igm.nc"
 
-OUT_FOLDER_NAME = "res/" + RGI_ID
-FILES_TO_STORE = ["gridded_data.nc", "glacier_grid.json", "outlines.tar.gz"]
+# IGM inversions: seed thickness (shop field) -> resulting thickness field
+# Every inversion runs in its own directory TEMP_WD_IGM_INVERSION/RGI_ID/SEED
+IGM_INVERSION_SEEDS = {
+    "consensus_ice_thickness": "igm_inv_thickness",
+    # "millan_ice_thickness": "igm_millan_thickness",
+    # "cook23_thk": "igm_cook23_thickness",
+}
+IGM_INVERSION_WORKERS = 1  # number of inversions run at once (per glacier)
+IGM_INVERSION_SHM = False  # hand the input grids to IGM as .npy files in SHM_DIR/RGI_ID (common/shm_grids.py)
+
+FILES_TO_STORE = ["glacier_grid.json", "outlines.tar.gz"]  # gridded_data.nc is written by write_gridded_data
+
+# Thickness fields set to NaN outside the glacier mask
+MASKED_FIELDS = ["millan_ice_thickness", "cook23_thk"] + list(IGM_INVERSION_SEEDS.values())
+
+# Renamed so that every thickness field contains three words
+RENAMED_FIELDS = {"cook23_thk": "cook23_ice_thickness"}
 
 ADD_IGM_INVERSION = True  # disable for debug
 
 
-def main():
+def main(rgi_id, n_inversion_workers=IGM_INVERSION_WORKERS):
     if os.path.basename(os.getcwd()) != "glacier-projections":
         print("Error: The parent directory must be 'glacier-projections'. Exiting.")
         sys.exit(1)
 
-    initialize_oggm(TEMP_WD)
+    temp_wd = TEMP_WD + "/" + rgi_id
+    initialize_oggm(temp_wd)
 
-    rgi_ids = get_outlines()
+    rgi_ids = get_outlines(rgi_id)
 
     # Init glacier dir
     gdirs = workflow.init_glacier_directories(rgi_ids, reset=True, force=True)
@@ -60,25 +77,26 @@ def main():
     add_thicknesses_from_shop(gdirs)
     add_additional_data_for_igm_inversion(gdirs)
 
+    # Fields added to the shop data, collected in memory and written once (see write_gridded_data)
+    fields = {}
+
     # OGGM inversion from another temporary gdir (level 3)
-    add_oggm_inversion_from_server(gdir)
+    fields["oggm_inv_distributed"] = oggm_inversion_from_server(gdir)
 
-    # Carry out IGM inversion and add the resulting thickness
+    # Carry out IGM inversions and add the resulting thicknesses
     if ADD_IGM_INVERSION:
-        add_igm_inversion(gdir)
-
-    # Set all thicknesses to NAN outside the mask
-    set_outside_to_nan(gdir)
-
-    # Rename cook var so that every thickness field contains three words
-    rename_cook_var(gdir)
+        fields.update(igm_inversions(gdir, n_inversion_workers))
 
     # Copy the files and delete the temporary gdir
-    if not os.path.exists("initial-geometries/" + OUT_FOLDER_NAME):
-        os.makedirs("initial-geometries/" + OUT_FOLDER_NAME)
+    out_folder = "initial-geometries/res/" + rgi_id
+    if not os.path.exists(out_folder):
+        os.makedirs(out_folder)
+    write_gridded_data(gdir.dir + "/gridded_data.nc", fields, out_folder + "/gridded_data.nc")
     for file in FILES_TO_STORE:
-        shutil.copy(gdir.dir + "/" + file, "initial-geometries/" + OUT_FOLDER_NAME + "/" + file)
-    shutil.rmtree(TEMP_WD)
+        shutil.copy(gdir.dir + "/" + file, out_folder + "/" + file)
+    update_catalog([out_folder + "/gridded_data.nc"] + [out_folder + "/" + file for file in FILES_TO_STORE])
+    release(gdir.dir + "/gridded_data.nc")
+    shutil.rmtree(temp_wd)
 
 
 def initialize_oggm(WD):
@@ -93,8 +111,8 @@ def initialize_oggm(WD):
     cfg.PATHS["working_dir"] = WD
 
 
-def get_outlines():
-    rgi_ids = utils.get_rgi_glacier_entities([RGI_ID], version = "62")
+def get_outlines(rgi_id):
+    rgi_ids = utils.get_rgi_glacier_entities([rgi_id], version = "62")
     return rgi_ids
 
 
@@ -128,57 +146,117 @@ def add_additional_data_for_igm_inversion(gdirs):
     workflow.execute_entity_task(velocity_to_gdir, gdirs)
 
 
-def add_oggm_inversion_from_server(gdir):
-    cfg.PATHS["working_dir"] = TEMP_WD_OGGM_INVERSION
+def oggm_inversion_from_server(gdir):
+    temp_wd = TEMP_WD_OGGM_INVERSION + "/" + gdir.rgi_id
+    cfg.PATHS["working_dir"] = temp_wd
 
     # Get the pre-processed glacier directories
-    inversion_gdir = workflow.init_glacier_directories(RGI_ID, prepro_base_url=NO_SPINUP_URL, from_prepro_level=3, reset=True, force=True)[0]
+    inversion_gdir = init_cached_gdir(gdir.rgi_id, NO_SPINUP_URL, 3)
 
     # Thickness from inversion to 2D Field
     tasks.distribute_thickness_per_altitude(inversion_gdir)
 
-    # Copy to results nc
-    copy_variable_between_netcdfs(inversion_gdir.dir + "/gridded_data.nc", gdir.dir + "/gridded_data.nc", "distributed_thickness", "oggm_inv_distributed")
+    thickness = read_variables(inversion_gdir.dir + "/gridded_data.nc", ["distributed_thickness"])["distributed_thickness"]
 
     # Clean gdir
-    shutil.rmtree(TEMP_WD_OGGM_INVERSION)
-
-
-def add_igm_inversion(gdir):
-    # We need to rename the variables in the nc for IGM
-    oggm_nc_to_igm_nc(gdir.dir + "/gridded_data.nc", TEMP_IGM_NC)
-
-    # Run igm inversion (includes cleaning of temp files)
-    subprocess.run([IGM_INVERSION_BASH_SCRIPT, IGM_INVERSION_PARAM_FILE])
-
-    # Copy thickness from IGM inversion to the main nc file
-    copy_variable_between_netcdfs("geology-optimized.nc", gdir.dir + "/gridded_data.nc", "thk", "igm_inv_thickness")
+    release(inversion_gdir.dir + "/gridded_data.nc")
+    shutil.rmtree(temp_wd)
+    return thickness
+
+
+def igm_inversions(gdir, n_workers=1):
+    # One inversion per available seed thickness, the IGM input files are created from a single read (see igm_inputs)
+    base_dir = TEMP_WD_IGM_INVERSION + "/" + gdir.rgi_id
+    if os.path.exists(base_dir):
+        shutil.rmtree(base_dir)
+
+    seeds = [seed for seed in IGM_INVERSION_SEEDS if seed in open_dataset(gdir.dir + "/gridded_data.nc")]
+    if not seeds:
+        print("No seed thickness for the IGM inversion of " + gdir.rgi_id)
+        return {}
+    input_dir = SHM_DIR + "/" + gdir.rgi_id + "/inversion_input" if IGM_INVERSION_SHM else os.path.abspath(base_dir + "/inputs")
+    inputs = igm_inputs(gdir.dir + "/gridded_data.nc", seeds, input_dir, shm=IGM_INVERSION_SHM)
+
+    jobs = [(inputs[seed], base_dir + "/" + seed) for seed in seeds]
+    if n_workers <= 1:
+        thicknesses = [igm_inversion(*job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            thicknesses = list(executor.map(igm_inversion, *zip(*jobs)))
 
     # Clean
-    os.remove("geology-optimized.nc")
-    os.remove(TEMP_IGM_NC)
+    shutil.rmtree(base_dir)
+    if IGM_INVERSION_SHM:
+        shutil.rmtree(input_dir)
+    return {IGM_INVERSION_SEEDS[seed]: thickness for seed, thickness in zip(seeds, thicknesses)}
 
 
-def set_outside_to_nan(gdir):
-    ds_res = xr.open_dataset(gdir.dir + "/gridded_data.nc", mode="r+")
-    ds_res["millan_ice_thickness"] = ds_res["millan_ice_thickness"].where(ds_res["glacier_mask"] != 0, np.nan)
-    if ADD_IGM_INVERSION:
-        ds_res["igm_inv_thickness"] = ds_res["igm_inv_thickness"].where(ds_res["glacier_mask"] != 0, np.nan)
-    if "cook23_thk" in ds_res:
-        ds_res["cook23_thk"] = ds_res["cook23_thk"].where(ds_res["glacier_mask"] != 0, np.nan)
-    ds_res.to_netcdf(gdir.dir + "/gridded_data.nc", mode="a")
-    ds_res.close()
-
+def igm_inversion(igm_nc, run_dir):
+    # IGM writes its results to the CWD, so every inversion gets its own directory and absolute paths
+    os.makedirs(run_dir)
 
-def rename_cook_var(gdir):
-    ds = xr.open_dataset(gdir.dir + "/gridded_data.nc", mode="r+")
-    ds.load()  # Load all into memory
-    ds.close()  # Close file handle before overwriting
+    params = load_json_with_comments(IGM_INVERSION_PARAM_FILE)
+    params["lncd_input_file"] = igm_nc
+    if is_descriptor(igm_nc):
+        use_shm_input(params, igm_nc, run_dir)
+    params_file = os.path.abspath(run_dir + "/igm_inv_params.json")
+    save_json_to_file(params, params_file)
 
-    if "cook23_thk" in ds:
-        ds = ds.rename({"cook23_thk": "cook23_ice_thickness"})
-
-    ds.to_netcdf(gdir.dir + "/gridded_data.nc", mode="w")
-
-
-main()
+    # Run igm inversion (includes cleaning of temp files)
+    # The return code is the one of the cleaning, so the result file is checked instead
+    subprocess.run([os.path.abspath(IGM_INVERSION_BASH_SCRIPT), params_file], cwd=run_dir)
+    if not os.path.exists(run_dir + "/geology-optimized.nc"):
+        raise RuntimeError("IGM inversion failed for " + igm_nc)
+
+    # Thickness from IGM inversion
+    thickness = read_variables(run_dir + "/geology-optimized.nc", ["thk"])["thk"]
+    release(run_dir + "/geology-optimized.nc")
+    return thickness
+
+
+def write_gridded_data(gridded_data_file, fields, out):
+    # Shop data + additional fields, masked and renamed, written in one pass
+    # The result is written to a temporary file first, so a crash never leaves a partial file
+    # The shop data is read lazily, the fields one by one
+    ds = open_dataset(gridded_data_file).assign(fields)
+
+    # Set to NaN outside the mask, only the mask cells are processed (see common/masked_grid.py)
+    grid = masked_grid(ds["glacier_mask"].values)
+    for name in MASKED_FIELDS:
+        if name in ds:
+            values = compress(grid, ds[name].values)
+            values = values.astype(np.result_type(values.dtype, np.float32))
+            ds[name] = ds[name].copy(data=expand(grid, values, np.nan))
+
+    ds = ds.rename({name: new_name for name, new_name in RENAMED_FIELDS.items() if name in ds})
+    print_thickness_stats(ds, grid)
+
+    ds.to_netcdf(out + ".tmp", encoding=gridded_data_encoding(ds))
+    release(out)
+    os.replace(out + ".tmp", out)
+
+
+def print_thickness_stats(ds, grid):
+    dx = abs(float(ds["x"][1] - ds["x"][0]))
+    for name in ds.data_vars:
+        if "thickness" in name or name == "oggm_inv_distributed":
+            stats = thickness_stats(grid, ds[name].values, dx)
+            print(name + ": volume " + str(round(stats["volume_m3"] * 1e-9, 4)) + " km3, mean " + str(round(stats["mean_thickness"], 1)) + " m, max " + str(round(stats["max_thickness"], 1)) + " m")
+
+
+def gridded_data_encoding(ds):
+    # Compressed, one chunk per field (fields are always read as a whole)
+    # Only the type and fill value of the source encoding are kept (the chunks of the shop files do not fit)
+    encoding = {}
+    for name, var in ds.data_vars.items():
+        encoding[name] = {key: value for key, value in var.encoding.items() if key in ["dtype", "_FillValue", "scale_factor", "add_offset"]}
+        if var.ndim > 0:
+            encoding[name].update({"zlib": True, "complevel": 4, "chunksizes": var.shape})
+    return encoding
+
+
+if __name__ == "__main__":
+    # Arguments: RGI_ID [N_INVERSION_WORKERS]
+    rgi_id = "RGI60-11.01450" if len(sys.argv) <= 1 else sys.argv[1]
+    n_inversion_workers = IGM_INVERSION_WORKERS if len(sys.argv) <= 2 else int(sys.argv[2])
+    main(rgi_id, n_inversion_workers)
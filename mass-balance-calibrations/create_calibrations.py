@@ -2,84 +2,138 @@
 # One is the default OGGM informed threestep calibration
 # Second is based on the order of parameter adjustement from Huss and Hock 2015
 # Third is an experimental calibration where only ddf (melt_f) is adjusted and precip_f (1) and temp_bias (0) are kept constant
+# The second and third calibration (and further schemes in CALIBRATION_SCHEMES) are solved for all glaciers at once (common/calibration.py)
 
+import json
 import os
 import shutil
 import sys
+import numpy as np
 import oggm.cfg as cfg
 import oggm.workflow as workflow
+import xarray as xr
 
-if len(sys.argv) <= 1:
-    RGI_ID = "RGI60-11.01450"
-else:
-    RGI_ID = sys.argv[1]
+# Import utils
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from common.gdir_cache import init_cached_gdir
+from common.catalog import update_catalog
+from common.calibration import calibrate
 
-TEMP_WD = "mass-balance-calibrations/temp"
+TEMP_WD = "mass-balance-calibrations/temp"  # TEMP_WD/RGI_ID
 
 NO_SPINUP_URL = "https://cluster.klima.uni-bremen.de/~oggm/gdirs/oggm_v1.6/L3-L5_files/2023.3/elev_bands/W5E5"
 
-OUT_FOLDER_NAME = "res/" + RGI_ID
+# Calibrations without the informed threestep: parameter order, default values and bounds
+# Parameters that are not calibrated keep their default value
+CALIBRATION_SCHEMES = {
+    # 2. Here we keep the standard ranges from OGGM for W5E5 climate but use the calibration order from Huss and Hock 2025
+    "order_husshock": {
+        "order": ["prcp_fac", "melt_f", "temp_bias"],
+        "defaults": {"melt_f": 6, "prcp_fac": 1.5, "temp_bias": 0},
+        "bounds": {"melt_f": (3.5, 9), "prcp_fac": (0.8, 2), "temp_bias": (-8, 8)},
+    },
+    # 3. This is a rather experimental calibration where only the the ddf is adjusted and no climate correction is applied
+    #    Min and max values are from Schuster 2023
+    "meltf_only": {
+        "order": ["melt_f", "prcp_fac", "temp_bias"],
+        "defaults": {"melt_f": 6, "prcp_fac": 1.5, "temp_bias": 0},
+        "bounds": {"melt_f": (3.5, 9), "prcp_fac": (0.8, 2), "temp_bias": (-8, 8)},
+    },
+}
+
 
+def main(rgi_id):
+    calibrate_glaciers([rgi_id])
 
-def main():
+
+def calibrate_glaciers(rgi_ids):
     if os.path.basename(os.getcwd()) != "glacier-projections":
         print("Error: The parent directory must be 'glacier-projections'. Exiting.")
         sys.exit(1)
 
     cfg.initialize()
 
-    cfg.PATHS["working_dir"] = TEMP_WD
-
-    # Get the pre-processed glacier directories
-    mb_gdir = workflow.init_glacier_directories(RGI_ID, prepro_base_url=NO_SPINUP_URL, from_prepro_level=3, reset=True, force=True)[0]
-
-    # 1. Informed threestep
-    workflow.tasks.mb_calibration_from_geodetic_mb(mb_gdir, filesuffix="_informed_threestep", informed_threestep=True)
-
-    # Disable the informed calibration for additional calibrations
-    cfg.PARAMS["use_temp_bias_from_file"] = False
-    cfg.PARAMS["use_winter_prcp_fac"] = False
-    cfg.PARAMS["prcp_fac"] = 1
-
-    #cfg.PARAMS["melt_f"] = 4.5
-    #cfg.PARAMS["melt_f_min"] = 2.65
-    #cfg.PARAMS["melt_f_max"] = 6.75
-    cfg.PARAMS["melt_f"] = 6
-    cfg.PARAMS["melt_f_min"] = 3.5
-    cfg.PARAMS["melt_f_max"] = 9
-
-    cfg.PARAMS["prcp_fac"] = 1.5
-    cfg.PARAMS["prcp_fac_min"] = 0.8
-    cfg.PARAMS["prcp_fac_max"] = 2
-
-    # 2. Here we keep the standard ranges from OGGM for W5E5 climate but use the calibration order from Huss and Hock 2025
-    workflow.tasks.mb_calibration_from_geodetic_mb(
-        mb_gdir,
-        calibrate_param1="prcp_fac",
-        calibrate_param2="melt_f",
-        calibrate_param3="temp_bias",
-        filesuffix="_order_husshock",
-    )
-
-    # 3. This is a rather experimental calibration where only the the ddf is adjusted and no climate correction is applied
-    #    Min and max values are from Schuster 2023
-    workflow.tasks.mb_calibration_from_geodetic_mb(
-        mb_gdir,
-        calibrate_param1="melt_f",
-        calibrate_param2="prcp_fac",
-        calibrate_param3="temp_bias",
-        filesuffix="_meltf_only",
-    )
-
-    # Store the results
-    if not os.path.exists("mass-balance-calibrations/" + OUT_FOLDER_NAME):
-        os.makedirs("mass-balance-calibrations/" + OUT_FOLDER_NAME)
-    shutil.copy(mb_gdir.dir + "/mb_calib_informed_threestep.json", "mass-balance-calibrations/" + OUT_FOLDER_NAME + "/informed_threestep.json")
-    shutil.copy(mb_gdir.dir + "/mb_calib_meltf_only.json", "mass-balance-calibrations/" + OUT_FOLDER_NAME + "/meltf_only.json")
-    shutil.copy(mb_gdir.dir + "/mb_calib_order_husshock.json", "mass-balance-calibrations/" + OUT_FOLDER_NAME + "/order_husshock.json")
-
-    # Clean gdir
-    shutil.rmtree(TEMP_WD)
-
-
-main()
+    # 1. Informed threestep (OGGM), it also provides the reference MB of every glacier
+    glaciers = []
+    for rgi_id in rgi_ids:
+        temp_wd = TEMP_WD + "/" + rgi_id
+        cfg.PATHS["working_dir"] = temp_wd
+
+        # Get the pre-processed glacier directories
+        mb_gdir = init_cached_gdir(rgi_id, NO_SPINUP_URL, 3)
+
+        workflow.tasks.mb_calibration_from_geodetic_mb(mb_gdir, filesuffix="_informed_threestep", informed_threestep=True)
+
+        out_folder = "mass-balance-calibrations/res/" + rgi_id
+        if not os.path.exists(out_folder):
+            os.makedirs(out_folder)
+        shutil.copy(mb_gdir.dir + "/mb_calib_informed_threestep.json", out_folder + "/informed_threestep.json")
+
+        glaciers.append(glacier_inputs(mb_gdir, out_folder + "/informed_threestep.json"))
+
+        # Clean gdir
+        shutil.rmtree(temp_wd)
+
+    # 2. and 3. for all glaciers at once
+    results = calibrate(glaciers, CALIBRATION_SCHEMES)
+
+    # Glaciers and schemes without parameters within the bounds that match the reference MB
+    failed = [(rgi_id, name) for name, params in results.items() for i, rgi_id in enumerate(rgi_ids) if np.isnan(params["melt_f"][i])]
+
+    # Store the results (same format as the OGGM calibration files), the files of failed calibrations are removed
+    for i, rgi_id in enumerate(rgi_ids):
+        out_folder = "mass-balance-calibrations/res/" + rgi_id
+        with open(out_folder + "/informed_threestep.json", "r") as file:
+            informed = json.load(file)
+
+        for name, params in results.items():
+            if (rgi_id, name) in failed:
+                if os.path.exists(out_folder + "/" + name + ".json"):
+                    os.remove(out_folder + "/" + name + ".json")
+                continue
+            calib = dict(informed)
+            calib.update({param: float(params[param][i]) for param in ["melt_f", "prcp_fac", "temp_bias"]})
+            with open(out_folder + "/" + name + ".json", "w") as file:
+                json.dump(calib, file)
+
+        update_catalog([out_folder + "/informed_threestep.json"] + [out_folder + "/" + name + ".json" for name in CALIBRATION_SCHEMES])
+
+    if failed:
+        raise RuntimeError("No parameters within the bounds match the reference MB for: " + ", ".join(rgi_id + " " + name for rgi_id, name in failed))
+
+
+def glacier_inputs(gdir, informed_calib_file):
+    # Elevation bands and climate of the reference period (see common/calibration.py)
+    with open(informed_calib_file, "r") as file:
+        informed = json.load(file)
+
+    fls = gdir.read_pickle("inversion_flowlines")
+    heights = np.concatenate([fl.surface_h for fl in fls])
+    weights = np.concatenate([fl.widths_m * fl.dx_meter for fl in fls])
+
+    # e.g. "2000-01-01_2020-01-01": calendar years 2000 to 2019
+    start, end = informed["reference_period"].split("_")
+    last_year = str(int(end[:4]) - 1)
+    with xr.open_dataset(gdir.get_filepath("climate_historical")) as ds:
+        ds = ds.sel(time=slice(start, last_year + "-12-31"))
+        temp = ds["temp"].values
+        prcp = ds["prcp"].values
+        ref_hgt = ds.attrs["ref_hgt"]
+
+    return {
+        "heights": heights,
+        "weights": weights,
+        "temp": temp,
+        "prcp": prcp,
+        "ref_hgt": ref_hgt,
+        "reference_mb": informed["reference_mb"],
+        "mb_global_params": informed["mb_global_params"],
+    }
+
+
+if __name__ == "__main__":
+    # Arguments: [RGI_ID ...], all glaciers are calibrated together
+    if len(sys.argv) <= 1:
+        calibrate_glaciers(["RGI60-11.01450"])
+    else:
+        calibrate_glaciers(sys.argv[1:])
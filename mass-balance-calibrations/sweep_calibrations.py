@@ -0,0 +1,159 @@
+# Sweep of the calibration settings: every combination of parameter order, defaults and bounds in SWEEP is one calibration
+# The climate of a glacier is reduced once to aggregates (solid precipitation and melt on a temp_bias grid, common/calibration.py)
+# and cached, so every sweep point is only an array operation and no OGGM mass balance evaluation
+# Requires the informed threestep calibration of create_calibrations.py (reference MB)
+
+import csv
+import hashlib
+import itertools
+import json
+import os
+import shutil
+import sys
+import numpy as np
+import oggm.cfg as cfg
+
+# Import utils
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+from common.utils import file_hash, file_lock
+from common.gdir_cache import init_cached_gdir
+from common.catalog import update_catalog
+from common import calibration
+from common.calibration import PARAMS, calibrate, climate_aggregates
+from create_calibrations import NO_SPINUP_URL, glacier_inputs
+
+TEMP_WD = "mass-balance-calibrations/temp_sweep"  # TEMP_WD/RGI_ID
+AGGREGATE_CACHE = "mass-balance-calibrations/cache"  # AGGREGATE_CACHE/RGI_ID/aggregates_HASH.npz
+SWEEP_TABLE = "sweep.csv"  # in mass-balance-calibrations/res/RGI_ID, next to one calibration file (NAME.json) per sweep point
+
+# Values per setting, the sweep is their product
+# melt_f, prcp_fac, temp_bias: (default, min, max)
+SWEEP = {
+    "order": [["prcp_fac", "melt_f", "temp_bias"], ["melt_f", "prcp_fac", "temp_bias"]],
+    "melt_f": [(5, 1.5, 17), (6, 3.5, 9), (6, 2, 12)],
+    "prcp_fac": [(1, 0.5, 3), (1.5, 0.8, 2), (1.5, 1, 1.5)],
+    "temp_bias": [(0, -8, 8), (0, -2, 2)],
+}
+
+
+def main(rgi_ids):
+    if os.path.basename(os.getcwd()) != "glacier-projections":
+        print("Error: The parent directory must be 'glacier-projections'. Exiting.")
+        sys.exit(1)
+
+    schemes = sweep_schemes(SWEEP)
+    aggregates = [glacier_aggregates(rgi_id) for rgi_id in rgi_ids]
+
+    # All sweep points for all glaciers at once
+    results = calibrate(aggregates, schemes)
+
+    for i, rgi_id in enumerate(rgi_ids):
+        out_folder = "mass-balance-calibrations/res/" + rgi_id
+        write_sweep(out_folder, schemes, {name: {param: params[param][i] for param in PARAMS} for name, params in results.items()})
+
+
+def sweep_schemes(sweep):
+    # Calibration schemes (as in create_calibrations.CALIBRATION_SCHEMES) named after a hash of their settings,
+    # so the names (and the projections with them) stay the same when the sweep is extended
+    schemes = {}
+    for order, *settings in itertools.product(sweep["order"], *[sweep[param] for param in PARAMS]):
+        scheme = {
+            "order": list(order),
+            "defaults": {param: setting[0] for param, setting in zip(PARAMS, settings)},
+            "bounds": {param: (setting[1], setting[2]) for param, setting in zip(PARAMS, settings)},
+        }
+        name = "sweep_" + hashlib.sha256(json.dumps(scheme, sort_keys=True).encode()).hexdigest()[:8]
+        schemes[name] = scheme
+    return schemes
+
+
+def glacier_aggregates(rgi_id):
+    # The aggregates depend on the gdir (flowlines, climate: fixed by the prepro URL) and the reference period / MB
+    informed_file = "mass-balance-calibrations/res/" + rgi_id + "/informed_threestep.json"
+    if not os.path.exists(informed_file):
+        raise RuntimeError("No informed threestep calibration for " + rgi_id + ", run create_calibrations.py first")
+
+    settings = [file_hash(informed_file), NO_SPINUP_URL, calibration.AGGREGATE_TEMP_BIAS_RANGE, calibration.AGGREGATE_TEMP_BIAS_STEP]
+    key = hashlib.sha256(json.dumps(settings).encode()).hexdigest()[:16]
+    cache_dir = AGGREGATE_CACHE + "/" + rgi_id
+    cache_file = cache_dir + "/aggregates_" + key + ".npz"
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with file_lock(cache_dir + "/lock"):
+        if os.path.exists(cache_file):
+            with np.load(cache_file) as cached:
+                return {name: cached[name] for name in cached.files}
+
+        aggregates = climate_aggregates(sweep_glacier_inputs(rgi_id, informed_file))
+
+        # Older aggregates of this glacier are stale
+        for name in os.listdir(cache_dir):
+            if name.startswith("aggregates_"):
+                os.remove(cache_dir + "/" + name)
+        np.savez(cache_dir + "/tmp.npz", **aggregates)
+        os.replace(cache_dir + "/tmp.npz", cache_file)
+
+    return aggregates
+
+
+def sweep_glacier_inputs(rgi_id, informed_file):
+    cfg.initialize()
+    temp_wd = TEMP_WD + "/" + rgi_id
+    cfg.PATHS["working_dir"] = temp_wd
+
+    gdir = init_cached_gdir(rgi_id, NO_SPINUP_URL, 3)
+    glacier = glacier_inputs(gdir, informed_file)
+
+    # Clean gdir
+    shutil.rmtree(temp_wd)
+    return glacier
+
+
+def write_sweep(out_folder, schemes, results):
+    # One row per sweep point (settings and calibrated parameters) and the calibration files of the successful points
+    with open(out_folder + "/informed_threestep.json", "r") as file:
+        informed = json.load(file)
+
+    columns = ["name", "order"]
+    for param in PARAMS:
+        columns += [param + "_default", param + "_min", param + "_max"]
+    columns += PARAMS + ["success"]
+
+    rows = []
+    files = []
+    for name, scheme in schemes.items():
+        success = not np.isnan(results[name]["melt_f"])
+        row = {"name": name, "order": " ".join(scheme["order"]), "success": int(success)}
+        for param in PARAMS:
+            row[param + "_default"] = scheme["defaults"][param]
+            row[param + "_min"], row[param + "_max"] = scheme["bounds"][param]
+            row[param] = float(results[name][param]) if success else ""
+        rows.append(row)
+
+        if success:
+            calib = dict(informed)
+            calib.update({param: float(results[name][param]) for param in PARAMS})
+            with open(out_folder + "/" + name + ".json", "w") as file:
+                json.dump(calib, file)
+            files.append(out_folder + "/" + name + ".json")
+
+    # Calibration files of sweep points which are no longer in SWEEP or failed now
+    for name in os.listdir(out_folder):
+        if name.startswith("sweep_") and name.endswith(".json") and out_folder + "/" + name not in files:
+            os.remove(out_folder + "/" + name)
+
+    with open(out_folder + "/" + SWEEP_TABLE, "w", newline="") as file:
+        writer = csv.DictWriter(file, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    update_catalog(files + [out_folder + "/" + SWEEP_TABLE])
+
+
+if __name__ == "__main__":
+    # Arguments: [RGI_ID ...], all glaciers are swept together
+    if len(sys.argv) <= 1:
+        main(["RGI60-11.01450"])
+    else:
+        main(sys.argv[1:])
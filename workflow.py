@@ -1,8 +1,59 @@
+# Run the four pipeline stages for a batch of glaciers
+# RGI IDs are given on the command line, directly or as text files with one ID per line
+# Without arguments, all glaciers with results in */res/ are processed
+# Every glacier is processed in one worker process, its stages are run by the DAG runner (common/dag.py)
+# Only stages with changed inputs are rebuilt, climate, calibrations and initial geometries are independent
+
+import argparse
+import glob
+import importlib.util
 import os
-import subprocess
 import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from common.dag import run_dag
+from common.instrument import instrument
+from common.utils import glacier_paths
+
+STAGES = [
+    "initial-geometries/get_initial_data.py",
+    "climate-background/create_climate_file.py",
+    "mass-balance-calibrations/create_calibrations.py",
+    "forward-runs/run_projections.py",
+]
+
+# Code and parameter files read by the stages besides the stage script, changes trigger a rebuild
+# The common modules are listed with the modules they import (common/utils.py imports masked_grid, datasets and shm_grids)
+COMMON_UTILS = ["common/utils.py", "common/masked_grid.py", "common/datasets.py", "common/shm_grids.py", "common/gdir_cache.py", "common/catalog.py"]
+STAGE_INPUTS = [
+    COMMON_UTILS + [
+        "common/load_shm.py",
+        "initial-geometries/igm_inv/igm_inv_params.json",
+        "initial-geometries/igm_inv/igm_run.sh",
+    ],
+    COMMON_UTILS,
+    COMMON_UTILS + ["common/calibration.py"],
+    COMMON_UTILS + [
+        "common/igm_client.py",
+        "common/result_store.py",
+        "common/manifest.py",
+        "common/instrument.py",
+        "common/smb.py",
+        "common/smb_table.py",
+        "common/load_shm.py",
+        "common/ensemble_stats.py",
+        "forward-runs/igm_forward/params_ti.json",
+        "forward-runs/igm_forward/igm_run.sh",
+        "forward-runs/igm_forward/igm_worker.py",
+        "forward-runs/igm_forward/igm_worker.sh",
+    ],
+]
+
+CALIBS = ["informed_threestep", "order_husshock", "meltf_only"]
+STATE_DIR = "workflow_state"  # STATE_DIR/RGI_ID.json, hashes of the stage inputs and outputs
 
-RGI_ID = "RGI60-09.00971"
+# Stage modules are only loaded once per process
+_loaded_stages = {}
 
 
 def main():
@@ -10,13 +61,123 @@ def main():
         print("Error: The parent directory must be 'glacier-projections'. Exiting.")
         sys.exit(1)
 
-    subprocess.run(["python", "initial-geometries/get_initial_data.py", RGI_ID])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("rgi_ids", nargs="*", help="RGI IDs or text files with one RGI ID per line")
+    parser.add_argument("--processes", type=int, default=1, help="Number of glaciers processed in parallel")
+    parser.add_argument("--run-workers", type=int, default=1, help="Number of parallel forward runs per glacier")
+    parser.add_argument("--stage-workers", type=int, default=1, help="Number of independent stages run in parallel per glacier")
+    parser.add_argument("--force", action="store_true", help="Rebuild all stages")
+    args = parser.parse_args()
+
+    rgi_ids = get_rgi_ids(args.rgi_ids)
+    run_batch(rgi_ids, args.processes, args.run_workers, args.stage_workers, args.force)
+
+
+def get_rgi_ids(args):
+    if not args:
+        return discover_rgi_ids()
+
+    rgi_ids = []
+    for arg in args:
+        if os.path.isfile(arg):
+            with open(arg, "r") as file:
+                for line in file:
+                    line = line.split("#")[0].strip()
+                    if line:
+                        rgi_ids.append(line)
+        else:
+            rgi_ids.append(arg)
+    return rgi_ids
+
+
+def discover_rgi_ids():
+    rgi_ids = set()
+    for path in glob.glob("*/res/RGI*"):
+        if os.path.isdir(path):
+            rgi_ids.add(os.path.basename(path))
+    return sorted(rgi_ids)
+
+
+def run_batch(rgi_ids, n_processes=1, n_run_workers=1, n_stage_workers=1, force=False):
+    if n_processes <= 1:
+        for rgi_id in rgi_ids:
+            process_glacier(rgi_id, n_run_workers, n_stage_workers, force)
+        return
+
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        futures = [executor.submit(process_glacier, rgi_id, n_run_workers, n_stage_workers, force) for rgi_id in rgi_ids]
+        for future in futures:
+            future.result()
+
+
+def process_glacier(rgi_id, n_run_workers=1, n_stage_workers=1, force=False):
+    print("Processing " + rgi_id)
+    run_dag(glacier_stages(rgi_id, n_run_workers), STATE_DIR + "/" + rgi_id + ".json", n_stage_workers, force)
+
+
+def glacier_stages(rgi_id, n_run_workers=1):
+    # Declared inputs and outputs of the four stages, the stage scripts and STAGE_INPUTS are inputs so code changes trigger a rebuild
+    paths = glacier_paths(rgi_id)
+    return [
+        {
+            "name": "initial_geometries",
+            "deps": [],
+            "func": run_stage,
+            "args": [STAGES[0], rgi_id],
+            "inputs": [STAGES[0]] + STAGE_INPUTS[0],
+            "params": {"rgi_id": rgi_id},
+            "outputs": [paths["gridded_data"], paths["glacier_grid"], paths["outlines"]],
+        },
+        {
+            "name": "climate",
+            "deps": [],
+            "func": run_stage,
+            "args": [STAGES[1], rgi_id],
+            "inputs": [STAGES[1]] + STAGE_INPUTS[1],
+            "params": {"rgi_id": rgi_id},
+            "outputs": [paths["climate"]],
+        },
+        {
+            "name": "calibrations",
+            "deps": [],
+            "func": run_stage,
+            "args": [STAGES[2], rgi_id],
+            "inputs": [STAGES[2]] + STAGE_INPUTS[2],
+            "params": {"rgi_id": rgi_id},
+            "outputs": [paths["calibs"] + "/" + calib + ".json" for calib in CALIBS],
+        },
+        {
+            # The single runs are tracked by the run manifest of run_projections.py
+            "name": "projections",
+            "deps": ["initial_geometries", "climate", "calibrations"],
+            "func": run_stage,
+            "args": [STAGES[3], rgi_id, n_run_workers],
+            "inputs": [STAGES[3]] + STAGE_INPUTS[3],
+            "params": {"rgi_id": rgi_id},
+            "outputs": [paths["simulation_res"] + "/manifest.json"],
+        },
+    ]
+
 
-    subprocess.run(["python", "climate-background/create_climate_file.py", RGI_ID])
+def run_stage(path, *args):
+    # args[0] is the RGI ID for all stages
+    with instrument("stage", args[0], stage=os.path.splitext(os.path.basename(path))[0]):
+        load_stage(path).main(*args)
 
-    subprocess.run(["python", "mass-balance-calibrations/create_calibrations.py", RGI_ID])
 
-    subprocess.run(["python", "forward-runs/run_projections.py", RGI_ID])
+def load_stage(path):
+    # The stage folders are no python packages (hyphens), so the scripts are loaded from their file path
+    # They are registered under their file name, so functions can be pickled for process pools
+    if path not in _loaded_stages:
+        name = os.path.splitext(os.path.basename(path))[0]
+        sys.path.insert(0, os.path.abspath(os.path.dirname(path)))
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+        _loaded_stages[path] = module
+    return _loaded_stages[path]
 
 
-main()
+if __name__ == "__main__":
+    main()